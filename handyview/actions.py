@@ -138,10 +138,22 @@ def show_instruction_msg(parent):
 def set_fingerprint(parent):
     return new_action(parent, 'Fingerprint', icon_name='fingerprint.png', slot=parent.set_fingerprint)
 
+
+def build_index(parent):
+    return new_action(parent, 'Build Index', icon_name='fingerprint.png', slot=parent.build_index)
+
+
+def find_similar(parent):
+    return new_action(parent, 'Find Similar', icon_name='fingerprint.png', slot=parent.find_similar)
+
 def cal_metric(parent):
     return new_action(parent, 'Metric', icon_name='fingerprint.png', slot=parent.cal_metric)
 
 
+def set_metrics(parent):
+    return new_action(parent, 'Set Metrics', icon_name='fingerprint.png', slot=parent.set_metrics)
+
+
 # ---------------------------------------
 # auto zoom
 # ---------------------------------------
@@ -0,0 +1,243 @@
+"""
+Band decoding of giant images, for formats without clip-rect decoding.
+
+A band is a fixed number of full-width rows. BandReader decodes the bands of
+an image without ever decoding the full image:
+    non-interlaced 8-bit PNG: the pixel stream is inflated once, top to
+        bottom, and every band is kept as its rows arrive. A checkpoint (the
+        inflater state and the last row) is kept at each band, so that a band
+        evicted from the cache is decoded again from its own checkpoint;
+    TIFF (with tifffile): only the strips or tiles intersecting a band are read;
+    uncompressed images (e.g., PPM, BMP and raw TIFF): only the rows of a band are read.
+Other formats (e.g., WebP) cannot be decoded partially: they are decoded once,
+and split into bands.
+"""
+import struct
+import zlib
+from PIL import Image
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# PNG raw modes whose decoded rows are packed back losslessly (the last row of a band is a checkpoint)
+PNG_RAWMODES = ('L', 'LA', 'RGB', 'RGBA')
+# bands of other modes (e.g., palette) are converted to RGBA, so that they can be reduced to coarser levels
+BAND_MODES = ('L', 'LA', 'RGB', 'RGBA')
+TIFF_MODES = {1: 'L', 3: 'RGB', 4: 'RGBA'}  # samples per pixel: mode
+READ_SIZE = 1024 * 1024
+
+
+class BandReader():
+    """Decode the bands of an image. It is not thread-safe.
+
+    Args:
+        path (str): Image path.
+        band_height (int): Number of rows of a band.
+        keep (func): Called with (idx, band) for every decoded band, including
+            the bands above the requested one. Default: None.
+    """
+
+    def __init__(self, path, band_height, keep=None):
+        self.path = path
+        self.band_height = band_height
+        self.keep = keep
+        img = Image.open(path)
+        self.mode = img.mode
+        self.width, self.height = img.size
+        self.palette = img.getpalette() if img.mode == 'P' else None
+        self.num_bands = -(-self.height // band_height)
+        self.checkpoints = None  # PNG: band idx: (stream position, inflater, previous row)
+        if img.format == 'PNG' and self._is_png_streamable(img):
+            self.read_band = self._read_png_band
+            self.checkpoints = {0: (self._first_idat(img.tile[0][2]), zlib.decompressobj(), None)}
+            self.rawmode = img.tile[0][3]
+            self.row_bytes = self.width * len(self.rawmode) + 1  # with the filter type byte
+        elif img.format == 'TIFF' and tifffile is not None and self._open_tiff():
+            self.read_band = self._read_tiff_band
+        elif img.tile and all(tile[0] == 'raw' for tile in img.tile):
+            self.read_band = self._read_raw_band
+            self.tiles = img.tile
+        else:
+            self.read_band = self._read_full
+        img.close()
+
+    def band_rows(self, idx):
+        top = idx * self.band_height
+        return top, min(top + self.band_height, self.height)
+
+    def read(self, idx):
+        """Decode a band.
+
+        Returns:
+            PIL.Image: The band.
+        """
+        return self._keep(idx, self.read_band(idx))
+
+    def _keep(self, idx, band):
+        if band.mode not in BAND_MODES:
+            band = band.convert('RGBA')
+        if self.keep is not None:
+            self.keep(idx, band)
+        return band
+
+    # PNG: one inflater from the top, with a checkpoint at each band
+
+    @staticmethod
+    def _is_png_streamable(img):
+        return (len(img.tile) == 1 and img.tile[0][0] == 'zip' and img.tile[0][3] in PNG_RAWMODES
+                and img.mode == img.tile[0][3] and not img.info.get('interlace'))
+
+    def _first_idat(self, offset):
+        # offset is the data of the first IDAT chunk: (file position, bytes left in the chunk)
+        with open(self.path, 'rb') as f:
+            f.seek(offset - 8)
+            length = struct.unpack('>I', f.read(4))[0]
+        return offset, length
+
+    def _read_idat(self, f, position, size):
+        """Read up to size bytes of the IDAT stream from position, crossing the chunk boundaries."""
+        offset, left = position
+        data = []
+        while size > 0:
+            if left == 0:
+                f.seek(offset + 4)  # skip the CRC
+                header = f.read(8)
+                if len(header) < 8 or header[4:] != b'IDAT':
+                    break
+                offset, left = offset + 12, struct.unpack('>I', header[:4])[0]
+                continue
+            f.seek(offset)
+            chunk = f.read(min(size, left))
+            if not chunk:
+                break
+            data.append(chunk)
+            offset, left, size = offset + len(chunk), left - len(chunk), size - len(chunk)
+        return b''.join(data), (offset, left)
+
+    def _read_png_band(self, idx):
+        start = max(i for i in self.checkpoints if i <= idx)
+        position, inflater, previous = self.checkpoints[start]
+        inflater = inflater.copy()  # keep the checkpoint reusable
+        with open(self.path, 'rb') as f:
+            for i in range(start, idx + 1):
+                top, bottom = self.band_rows(i)
+                size = (bottom - top) * self.row_bytes
+                # the filters of the first row refer to the previous row, so it is prepended unfiltered
+                height = bottom - top
+                num = 0
+                if previous is not None:
+                    num = len(previous) + 1
+                    height += 1
+                size += num
+                rows = bytearray(size)
+                if previous is not None:
+                    rows[1:num] = previous
+                pending = inflater.unconsumed_tail
+                while num < size:
+                    if not pending:
+                        pending, position = self._read_idat(f, position, READ_SIZE)
+                        if not pending:
+                            raise OSError(f'Truncated PNG: {self.path}')
+                    out = inflater.decompress(pending, size - num)
+                    pending = inflater.unconsumed_tail
+                    rows[num:num + len(out)] = out
+                    num += len(out)
+                data = zlib.compress(rows, 0)
+                del rows
+                band = Image.frombytes(self.mode, (self.width, height), data, 'zip', self.rawmode)
+                del data
+                if previous is not None:
+                    band = band.crop((0, 1, self.width, height))
+                previous = band.crop((0, band.height - 1, self.width, band.height)).tobytes('raw', self.rawmode)
+                # the unconsumed input stays in the inflater copy
+                self.checkpoints[i + 1] = (position, inflater.copy(), previous)
+                if i < idx:
+                    self._keep(i, band)
+        return band
+
+    # TIFF: only the strips or tiles of a band
+
+    def _open_tiff(self):
+        with tifffile.TiffFile(self.path) as tiff:
+            page = tiff.pages[0]
+            # a single strip (e.g., rowsperstrip = height) is the full image
+            seg_height = page.tilelength if page.is_tiled else page.rowsperstrip
+            if (page.dtype != 'uint8' or page.samplesperpixel not in TIFF_MODES or page.planarconfig != 1
+                    or page.photometric not in (1, 2) or page.shape[:2] != (self.height, self.width)
+                    or seg_height > self.band_height):
+                return False
+            try:  # some compressions (e.g., JPEG and LZW) need the imagecodecs package
+                tifffile.TIFF.DECOMPRESSORS[page.compression]
+            except KeyError:
+                return False
+        return True
+
+    def _read_tiff_band(self, idx):
+        top, bottom = self.band_rows(idx)
+        with tifffile.TiffFile(self.path) as tiff:
+            page = tiff.pages[0]
+            samples = page.samplesperpixel
+            band = Image.new(TIFF_MODES[samples], (self.width, bottom - top))
+            if page.is_tiled:
+                seg_height, seg_width = page.tilelength, page.tilewidth
+            else:
+                seg_height, seg_width = page.rowsperstrip, self.width
+            num_cols = -(-self.width // seg_width)
+            fh = tiff.filehandle
+            for row in range(top // seg_height, (bottom - 1) // seg_height + 1):
+                for col in range(num_cols):
+                    index = row * num_cols + col
+                    fh.seek(page.dataoffsets[index])
+                    segment, (_, _, y, x, _), _ = page.decode(fh.read(page.databytecounts[index]), index)
+                    if segment is None:  # empty segment
+                        continue
+                    segment = segment[0, :min(seg_height, self.height - y), :min(seg_width, self.width - x)]
+                    if samples == 1:
+                        segment = segment[..., 0]
+                    # a segment may start above the band (the band height is not a multiple of its height)
+                    band.paste(Image.fromarray(segment), (x, y - top))
+        return band
+
+    # uncompressed images: only the rows of a band
+
+    def _read_raw_band(self, idx):
+        top, bottom = self.band_rows(idx)
+        band = Image.new(self.mode, (self.width, bottom - top))
+        with open(self.path, 'rb') as f:
+            for _, (x0, y0, x1, y1), offset, args in self.tiles:
+                rows_top, rows_bottom = max(top, y0), min(bottom, y1)
+                if rows_top >= rows_bottom:
+                    continue
+                args = (args, ) if isinstance(args, str) else tuple(args)
+                rawmode = args[0]
+                stride = args[1] if len(args) > 1 else 0
+                orientation = args[2] if len(args) > 2 else 1
+                if stride <= 0:
+                    stride = len(Image.new(self.mode, (x1 - x0, 1)).tobytes('raw', rawmode))
+                num = rows_bottom - rows_top
+                # rows are stored from the bottom with a negative orientation (e.g., BMP)
+                first = y1 - rows_bottom if orientation < 0 else rows_top - y0
+                f.seek(offset + first * stride)
+                part = Image.frombytes(self.mode, (x1 - x0, num), f.read(num * stride), 'raw', rawmode, stride,
+                                       orientation)
+                band.paste(part, (x0, rows_top - top))
+        if self.palette is not None:
+            band.putpalette(self.palette)
+        return band
+
+    # other formats: decoded once, and split into bands
+
+    def _read_full(self, idx):
+        img = Image.open(self.path)
+        img.load()
+        band = None
+        for i in range(self.num_bands):
+            top, bottom = self.band_rows(i)
+            part = img.crop((0, top, self.width, bottom))
+            if i == idx:
+                band = part
+            else:
+                self._keep(i, part)
+        return band
@@ -0,0 +1,160 @@
+"""
+Headless metric report over the compare folders, without the GUI.
+
+Usage:
+    python -m handyview.batch_metric --config history.json --metrics PSNR SSIM --output report.csv
+
+The compare folders are the view*_folder entries of the config (the same
+history.json used by the compare setting). view0_folder is the reference.
+Frames are aligned by their index in the sorted image lists. Results are
+written frame by frame (CSV, a JSON array for .json outputs, or JSON Lines
+for .jsonl outputs), followed by the per-folder averages. Non-finite values
+(e.g., PSNR of identical frames) are written as null in JSON.
+"""
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from handyview.metrics import METRIC_REGISTRY, calculate_metrics, read_image
+from handyview.utils import ROOT_DIR, get_compare_folders, get_img_list
+
+
+def evaluate_frame(args):
+    """Evaluate one aligned frame. It runs in a process pool.
+
+    Args:
+        args (tuple): (frame index, reference path, compare paths, metric names).
+
+    Returns:
+        tuple: (frame index, list[dict]) with the metrics of each compare path.
+    """
+    idx, ref_path, paths, names = args
+    try:
+        ref_img = read_image(ref_path)
+    except IOError as error:
+        print(f'Metric error: {error}')
+        return idx, [{} for _ in paths]
+    results = []
+    for path in paths:
+        try:
+            results.append(calculate_metrics(ref_img, read_image(path), names))
+        except (IOError, ValueError) as error:
+            print(f'Metric error: {error}')
+            results.append({})
+    return idx, results
+
+
+class ReportWriter():
+    """Stream rows to a CSV, a JSON (an array of records) or a JSON Lines file."""
+
+    def __init__(self, path, names):
+        self.names = names
+        self.is_json = path.endswith('.json')
+        self.is_jsonl = path.endswith('.jsonl')
+        self.num_records = 0
+        self.file = open(path, 'w', newline='')
+        if self.is_json:
+            self.file.write('[')
+        elif not self.is_jsonl:
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(['frame', 'folder', 'path'] + names)
+
+    def write(self, frame, folder, path, values):
+        if self.is_json or self.is_jsonl:
+            record = {'frame': frame, 'folder': folder, 'path': path}
+            for name in self.names:
+                value = values.get(name)
+                # Infinity and NaN are not valid JSON
+                record[name] = value if value is None or math.isfinite(value) else None
+            if self.is_jsonl:
+                self.file.write(json.dumps(record) + '\n')
+            else:
+                self.file.write((',\n' if self.num_records > 0 else '\n') + json.dumps(record))
+            self.num_records += 1
+        else:
+            self.writer.writerow([frame, folder, path] + [values.get(name, '') for name in self.names])
+
+    def close(self):
+        if self.is_json:
+            self.file.write('\n]\n')
+        self.file.close()
+
+
+def run_report(folders, names, output, num_workers=None, log_interval=100):
+    """Compute the metrics of every aligned frame of folders[1:] against folders[0].
+
+    Returns:
+        dict: {folder: {metric: average}}. Non-finite values (e.g., PSNR of
+            identical frames) are not included in the averages.
+    """
+    path_lists = [get_img_list(folder) for folder in folders]
+    num_frames = min(len(paths) for paths in path_lists)
+    if any(len(paths) != num_frames for paths in path_lists):
+        print(f'Folders have different number of images: {[len(paths) for paths in path_lists]}. '
+              f'Only the first {num_frames} frames are evaluated.')
+    tasks = [(idx, path_lists[0][idx], [paths[idx] for paths in path_lists[1:]], names) for idx in range(num_frames)]
+
+    sums = {folder: {name: [0., 0] for name in names} for folder in folders[1:]}
+    writer = ReportWriter(output, names)
+    start_time = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # map keeps the frame order, so rows are written as soon as they are ready
+            for done, (idx, results) in enumerate(executor.map(evaluate_frame, tasks, chunksize=4), 1):
+                for folder, paths, values in zip(folders[1:], path_lists[1:], results):
+                    writer.write(idx, folder, paths[idx], values)
+                    for name, value in values.items():
+                        if value is not None and math.isfinite(value):
+                            sums[folder][name][0] += value
+                            sums[folder][name][1] += 1
+                if done % log_interval == 0 or done == num_frames:
+                    fps = done / max(time.time() - start_time, 1e-6)
+                    print(f'{done} / {num_frames} frames, {fps:.1f} frames/s')
+
+        averages = {
+            folder: {name: (total / num if num > 0 else None)
+                     for name, (total, num) in folder_sums.items()}
+            for folder, folder_sums in sums.items()
+        }
+        for folder, values in averages.items():
+            writer.write('average', folder, '', values)
+    finally:
+        writer.close()
+    return averages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute metrics over the compare folders without the GUI.')
+    parser.add_argument(
+        '--config', type=str, default=os.path.join(ROOT_DIR, 'history.json'), help='Compare config (history.json).')
+    parser.add_argument(
+        '--metrics', type=str, nargs='+', default=['PSNR'], help=f'Metrics in {", ".join(METRIC_REGISTRY.keys())}.')
+    parser.add_argument('--output', type=str, default='metric_report.csv', help='Output .csv, .json or .jsonl file.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of processes. Default: number of CPUs.')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.metrics if name not in METRIC_REGISTRY]
+    if unknown:
+        parser.error(f'Unknown metrics: {", ".join(unknown)}')
+    with open(args.config, 'r') as jf:
+        config = json.load(jf)
+    folders = get_compare_folders(config)
+    if len(folders) < 2:
+        parser.error('The config should contain at least two view*_folder entries.')
+
+    averages = run_report(folders, args.metrics, args.output, num_workers=args.workers)
+    for folder, values in averages.items():
+        shown = ', '.join(f'{name}: {value:.4f}' if value is not None else f'{name}: None'
+                          for name, value in values.items())
+        print(f'{folder}\n\t{shown}')
+    print(f'The report is saved to {args.output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""
+Persistent cache for per-file results (fingerprints and metrics).
+
+Results are stored in a SQLite file and keyed by the file path together with
+its size and mtime, so they survive refreshes and sessions, and become
+invalid as soon as the file changes.
+
+It also keeps the image listings of large folders, keyed by the folder path
+and the directory mtime, so that opening a large unchanged folder skips the
+full scan.
+"""
+import os
+import sqlite3
+import threading
+
+from handyview.utils import ROOT_DIR
+
+CACHE_PATH = os.path.join(ROOT_DIR, 'cache.db')
+
+
+def norm_path(path):
+    return os.path.abspath(path).replace('\\', '/')
+
+
+class HVCache():
+    """HandyView persistent cache.
+
+    It is safe to use from worker threads. If the cache file cannot be
+    opened (e.g., read-only install folder), all the queries miss and all the
+    writes are ignored.
+
+    Args:
+        db_path (str): Path of the SQLite file. Default: CACHE_PATH.
+    """
+
+    def __init__(self, db_path=CACHE_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        try:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprint '
+                              '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, md5 TEXT, phash TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS metric '
+                              '(path TEXT, ref_path TEXT, name TEXT, size INTEGER, mtime REAL, '
+                              'ref_size INTEGER, ref_mtime REAL, value REAL, PRIMARY KEY (path, ref_path, name))')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS listing (folder TEXT PRIMARY KEY, mtime REAL, names TEXT)')
+            self.conn.commit()
+        except sqlite3.Error as error:
+            print(f'Cannot open the cache file {db_path}: {error}')
+            self.conn = None
+
+    def _query(self, sql, args):
+        if self.conn is None:
+            return None
+        with self._lock:
+            try:
+                return self.conn.execute(sql, args).fetchone()
+            except sqlite3.Error:
+                return None
+
+    def _write(self, sql, args, many=False):
+        if self.conn is None:
+            return
+        with self._lock:
+            try:
+                if many:
+                    self.conn.executemany(sql, args)
+                else:
+                    self.conn.execute(sql, args)
+                self.conn.commit()
+            except sqlite3.Error as error:
+                print(f'Cannot write the cache file {self.db_path}: {error}')
+
+    def get_fingerprint(self, path, size, mtime):
+        """Get the cached (md5, phash hex string) of a file. Missing values are None."""
+        row = self._query('SELECT md5, phash FROM fingerprint WHERE path=? AND size=? AND mtime=?',
+                          (norm_path(path), size, mtime))
+        if row is None:
+            return None, None
+        return row
+
+    def set_fingerprint(self, path, size, mtime, md5=None, phash=None):
+        self.set_fingerprints([(path, size, mtime, md5, phash)])
+
+    def set_fingerprints(self, rows):
+        """Store fingerprints in one transaction.
+
+        Args:
+            rows (list[tuple]): (path, size, mtime, md5, phash) for each file.
+                None values keep the stored ones, unless the file changed.
+        """
+        # all the expressions in SET refer to the values before the update
+        sql = ('INSERT INTO fingerprint VALUES (?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET '
+               'md5=CASE WHEN size=excluded.size AND mtime=excluded.mtime '
+               'THEN coalesce(excluded.md5, md5) ELSE excluded.md5 END, '
+               'phash=CASE WHEN size=excluded.size AND mtime=excluded.mtime '
+               'THEN coalesce(excluded.phash, phash) ELSE excluded.phash END, '
+               'size=excluded.size, mtime=excluded.mtime')
+        rows = [(norm_path(path), size, mtime, md5, None if phash is None else str(phash))
+                for path, size, mtime, md5, phash in rows]
+        self._write(sql, rows, many=True)
+
+    def get_metric(self, name, path, size, mtime, ref_path, ref_size, ref_mtime):
+        """Get the cached metric value of a file against a reference file."""
+        row = self._query(
+            'SELECT value FROM metric WHERE path=? AND ref_path=? AND name=? '
+            'AND size=? AND mtime=? AND ref_size=? AND ref_mtime=?',
+            (norm_path(path), norm_path(ref_path), name, size, mtime, ref_size, ref_mtime))
+        return None if row is None else row[0]
+
+    def set_metric(self, name, path, size, mtime, ref_path, ref_size, ref_mtime, value):
+        self._write('INSERT OR REPLACE INTO metric VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (norm_path(path), norm_path(ref_path), name, size, mtime, ref_size, ref_mtime, value))
+
+    def get_listing(self, folder, mtime):
+        """Get the cached image file names of a folder, if the directory mtime is unchanged. Otherwise None."""
+        row = self._query('SELECT names FROM listing WHERE folder=? AND mtime=?', (norm_path(folder), mtime))
+        if row is None:
+            return None
+        return row[0].split('\n') if row[0] else []
+
+    def set_listing(self, folder, mtime, names):
+        self._write('INSERT OR REPLACE INTO listing VALUES (?, ?, ?)', (norm_path(folder), mtime, '\n'.join(names)))
+
+    def close(self):
+        if self.conn is not None:
+            with self._lock:
+                self.conn.close()
+            self.conn = None
@@ -1,10 +1,15 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from PyQt5 import QtCore
-from PyQt5.QtGui import QColor, QImage, QPainter, QPen, QPixmap
+from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import QApplication, QGridLayout, QSplitter, QWidget
 
+from handyview.prefetch import NUM_PREFETCH, find_image, get_prefetcher
+from handyview.tiles import TiledImage, get_tile_loader, get_tiled_image, is_giant
+from handyview.utils import sizeof_fmt
 from handyview.view_scene import HVScene, HVView
 from handyview.widgets import ColorLabel, HVLable, show_msg
+from handyview.workers import get_fingerprint_worker
 
 
 class Canvas(QWidget):
@@ -29,6 +34,18 @@ class Canvas(QWidget):
         # for auto zoom ratio
         self.target_zoom_width = 0
 
+        # load the views of compare mode in parallel
+        self.view_executor = None
+        if self.num_view > 1:
+            self.view_executor = ThreadPoolExecutor(max_workers=self.num_view, thread_name_prefix='hv_view')
+
+        # decode neighbouring images in the background
+        self.prefetcher = get_prefetcher()
+        # compute fingerprints in the background
+        self.fingerprint_worker = get_fingerprint_worker()
+        self.fingerprint_worker.progress.connect(self.show_fingerprint_progress)
+        self.fingerprint_worker.computed.connect(self.on_fingerprint_computed)
+
         self.show_image(init=True)
 
     def init_widgets_layout(self):
@@ -198,11 +215,11 @@ class Canvas(QWidget):
         # refresh
         self.show_image()
 
-    def update_path_list(self):
-        is_same_len, img_len_list = self.db.update_path_list()
+    def update_path_list(self, folders=None, warn=True, rescan=True):
+        is_same_len, img_len_list = self.db.update_path_list(folders, rescan)
         show_str = 'Comparison:\n # for each folder:\n\t' + '\n\t'.join(map(str, img_len_list))
         self.comparison_label.setText(show_str)
-        if is_same_len is False:
+        if is_same_len is False and warn:
             msg = f'Comparison folders have differnet number of images.\n{show_str}'
             show_msg('Warning', 'Warning!', msg)
 
@@ -217,34 +234,86 @@ class Canvas(QWidget):
             else:
                 self.comparison_label.setStyleSheet('QLabel {color : black;}')
 
+    def get_view(self, idx, interval_mode):
+        """Get the path, meta and fingerprints shown in a view. They are cheap (stat and cached values).
+
+        Returns:
+            dict: The view, without the decoded image.
+        """
+        if interval_mode:
+            pidx = self.db.pidx + idx
+            fidx, base_fidx, base_pidx = self.db.fidx, self.db.fidx, self.db.pidx
+        else:
+            fidx = self.db.fidx + idx
+            pidx, base_fidx, base_pidx = self.db.pidx, self.db.fidx, self.db.pidx
+        img_path, fidx, pidx = self.db.get_path(fidx=fidx, pidx=pidx)
+        meta = self.db.get_meta(fidx=fidx, pidx=pidx)
+        view = dict(img_path=img_path, meta=meta, fingerprint_job=None)
+        if self.show_fingerprint:
+            view['md5'], view['phash'] = self.db.get_fingerprint(fidx=fidx, pidx=pidx, compute=False)
+            view['md5_0'], view['phash_0'] = self.db.get_fingerprint(fidx=base_fidx, pidx=base_pidx, compute=False)
+            if view['md5'] is None or view['phash'] is None:
+                view['fingerprint_job'] = (self.db, fidx, pidx, img_path)
+        return view
+
+    def load_image(self, img_path, meta):
+        """Load the image of a view. It does not touch the widgets, so it can run on worker threads.
+
+        Returns:
+            QImage | TiledImage: The decoded image, or the tile source of a giant image.
+        """
+        width, height = int(meta['width']), int(meta['height'])
+        if is_giant(width, height):
+            # giant images are decoded and shown tile by tile
+            return get_tiled_image(img_path, width, height, float(meta['mtime']))
+        return self.prefetcher.load(img_path, mtime=float(meta['mtime']))
+
     def show_image(self, init=False):
         interval_mode = (self.db.get_folder_len() == 1)
+        if self.show_metric and interval_mode:
+            show_msg('Critical', 'Error!', "Metric cannot be calculated in interval mode!")
+        show_metric = self.show_metric and not interval_mode
+        views = [self.get_view(idx, interval_mode) for idx in range(self.num_view)]
+        # the images shown before are taken from their cached pixmaps
+        for view in views:
+            view['qimg'] = find_image((view['img_path'], float(view['meta']['mtime'])))
+        if self.view_executor is None:
+            for view in views:
+                if view['qimg'] is None:
+                    view['qimg'] = self.load_image(view['img_path'], view['meta'])
+            if show_metric:
+                metrics = self.db.get_metrics(self.db.fidx, [self.db.fidx + idx for idx in range(self.num_view)])
+        else:
+            # decode the views in parallel, so the latency is the slowest view rather than the sum.
+            # the metrics are computed meanwhile on the GUI thread
+            futures = [
+                self.view_executor.submit(self.load_image, view['img_path'], view['meta'])
+                if view['qimg'] is None else None for view in views
+            ]
+            if show_metric:
+                metrics = self.db.get_metrics(self.db.fidx, [self.db.fidx + idx for idx in range(self.num_view)])
+            for view, future in zip(views, futures):
+                if future is not None:
+                    view['qimg'] = future.result()
+
+        # swap all the views together, with one repaint
+        for qview in self.qviews:
+            qview.setUpdatesEnabled(False)
+        fingerprint_jobs = [view['fingerprint_job'] for view in views if view['fingerprint_job'] is not None]
+        tiled_images = [view['qimg'] for view in views if isinstance(view['qimg'], TiledImage)]
         for idx, qscene in enumerate(self.qscenes):
             qview = self.qviews[idx]
-            if interval_mode:
-                pidx = self.db.pidx + idx
-                img_path = self.db.get_path(pidx=pidx)[0]
-                width, height = self.db.get_shape(pidx=pidx)
-                file_size = self.db.get_file_size(pidx=pidx)
-                color_type = self.db.get_color_type(pidx=pidx)
-                if self.show_fingerprint:
-                    md5, phash = self.db.get_fingerprint(pidx=pidx)
-                    md5_0, phash_0 = self.db.get_fingerprint(pidx=self.db.pidx)
-                if self.show_metric:
-                    show_msg('Critical', 'Error!', "Metric cannot be calculated in interval mode!")
-            else:
-                fidx = self.db.fidx + idx
-                img_path = self.db.get_path(fidx=fidx)[0]
-                width, height = self.db.get_shape(fidx=fidx)
-                file_size = self.db.get_file_size(fidx=fidx)
-                color_type = self.db.get_color_type(fidx=fidx)
-                if self.show_fingerprint:
-                    md5, phash = self.db.get_fingerprint(fidx=fidx)
-                    md5_0, phash_0 = self.db.get_fingerprint(fidx=self.db.fidx)
-                if self.show_metric:
-                    metric = self.db.get_metric(base_fidx=self.db.fidx, comp_fidx=fidx)
-
-            qimg = QImage(img_path)
+            view = views[idx]
+            img_path, meta, qimg = view['img_path'], view['meta'], view['qimg']
+            if self.show_fingerprint:
+                md5, phash, md5_0, phash_0 = view['md5'], view['phash'], view['md5_0'], view['phash_0']
+            if show_metric:
+                metric = metrics[idx]
+
+            width, height = int(meta['width']), int(meta['height'])
+            file_size = sizeof_fmt(int(meta['size']))
+            color_type = str(meta['mode'])
+
             self.img_path = img_path
             if idx == 0:
                 # for HVView, HVScene show_mouse_color.
@@ -282,7 +351,11 @@ class Canvas(QWidget):
             ]
             # show fingerprint
             if self.show_fingerprint:
-                if idx > 0:
+                if md5 is None or phash is None:
+                    # computed in the background
+                    shown_text.append(f'md5: {md5 or "computing..."}')
+                    shown_text.append(f'phash: {phash or "computing..."}')
+                elif idx > 0 and md5_0 is not None and phash_0 is not None:
                     md5_diff = (md5 == md5_0)
                     phash_diff = phash - phash_0
                     shown_text.append(f'md5: {md5_diff} - {md5}')
@@ -290,8 +363,10 @@ class Canvas(QWidget):
                 else:
                     shown_text.append(f'md5: {md5}')
                     shown_text.append(f'phash: {phash}')
-            if self.show_metric:
+            if show_metric:
                 for k, v in metric.items():
+                    if isinstance(v, float):
+                        v = f'{v:.4f}'
                     shown_text.append(f'{k}: {v}')
 
             if qview.hasFocus():
@@ -300,22 +375,9 @@ class Canvas(QWidget):
                 color = 'green'
             qview.set_shown_text(shown_text, color)
             # qview.viewport().update()
-            qpixmap = QPixmap.fromImage(qimg)
-
-            # draw border
-            if not interval_mode and len(self.qscenes) == 1 and self.db.fidx == 0:  # compare mode, the main image
-                painter = QPainter()
-                painter.begin(qpixmap)
-                pen = QPen(QColor(220, 0, 0), 5, QtCore.Qt.SolidLine)
-                painter.setPen(pen)
-                painter.drawRect(0, 0, qpixmap.width(), qpixmap.height())
-                painter.end()
-
-            qscene.clear()
-            qscene.addPixmap(qpixmap)
-            qscene.set_width_height(width, height)
-            # put image always in the center of a QGraphicsView
-            qscene.setSceneRect(0, 0, width, height)
+            # update the image items in place; the border marks the main image in compare mode
+            draw_border = not interval_mode and len(self.qscenes) == 1 and self.db.fidx == 0
+            qscene.set_image(qimg, (img_path, float(meta['mtime'])), border=draw_border)
             # set the scroll bar position, so that it can keep the same position in auto_zoom
             qview.verticalScrollBar().setSliderPosition(qview.vertical_scroll_value)
             qview.horizontalScrollBar().setSliderPosition(qview.horizontal_scroll_value)
@@ -350,6 +412,43 @@ class Canvas(QWidget):
                     qview.set_zoom(ratio)
         for qview in self.qviews:
             qview.set_transform()
+            qview.setUpdatesEnabled(True)
+
+        if fingerprint_jobs:
+            self.fingerprint_worker.set_jobs(fingerprint_jobs)
+        # tiles of the images that are no longer shown are not needed
+        get_tile_loader().cancel_others(tiled_images)
+        self.prefetch_images()
+
+    def show_fingerprint_progress(self, name, done, total):
+        if total > 0 and self.isVisible():
+            self.parent.set_statusbar(f'Fingerprint {name}: {done * 100 // total}%')
+
+    def on_fingerprint_computed(self, db, fidx, pidx, path, md5, phash):
+        # skipped if the image has moved, e.g., after a refresh
+        if db is not self.db or not self.db.set_fingerprint(fidx, pidx, path, md5, phash):
+            return
+        if self.show_fingerprint and self.isVisible():
+            self.show_image()
+
+    def get_view_paths(self, pidx):
+        """Get the image paths shown in all the views for the path index."""
+        if self.db.get_folder_len() == 1:  # interval mode
+            return [self.db.get_path(pidx=pidx + idx)[0] for idx in range(self.num_view)]
+        return [self.db.get_path(fidx=self.db.fidx + idx, pidx=pidx)[0] for idx in range(self.num_view)]
+
+    def prefetch_images(self, num=NUM_PREFETCH):
+        """Decode the images of the next steps (in the browsing direction) in the background."""
+        step = self.db.last_step
+        paths = []
+        # also keep the opposite neighbour, for flipping back and forth
+        for i in list(range(1, num + 1)) + [-1]:
+            try:
+                paths.extend(self.get_view_paths(self.db.pidx + step * i))
+            except IndexError:
+                # compare folders may have different lengths
+                continue
+        self.prefetcher.prefetch(paths)
 
     def dir_browse(self, step):
         self.db.path_browse(step)
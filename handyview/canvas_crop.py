@@ -4,12 +4,13 @@ import sys
 from PyQt5.QtCore import QSize
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import (QComboBox, QGridLayout, QGroupBox, QLabel, QLineEdit, QListWidget, QListWidgetItem,
-                             QPushButton, QScrollArea, QVBoxLayout, QWidget)
+                             QProgressDialog, QPushButton, QScrollArea, QVBoxLayout, QWidget)
 from shutil import rmtree
 from time import localtime, strftime
 
-from handyview.utils import ROOT_DIR, crop_images, scandir
+from handyview.utils import ROOT_DIR, get_folder_names, scandir
 from handyview.widgets import HLine, HVLable, show_msg
+from handyview.workers import CropWorker
 
 
 class CanvasCrop(QWidget):
@@ -25,6 +26,7 @@ class CanvasCrop(QWidget):
         super(CanvasCrop, self).__init__()
         self.parent = parent
         self.db = db  # database
+        self.crop_worker = None
 
         # initialize widgets and layout
         self.init_widgets_layout()
@@ -95,6 +97,13 @@ class CanvasCrop(QWidget):
             'yellow', 'green', 'red', 'magenta', 'matlab_blue', 'matlab_orange', 'matlab_yellow', 'matlab_purple',
             'matlab_green', 'matlab_liblue', 'matlab_brown'
         ])
+        # rects cropped in one pass, from all the folders
+        self.rect_list = QListWidget()
+        self.rect_list.setMaximumHeight(100)
+        button_add_rect = QPushButton('Add Rect', self)
+        button_add_rect.clicked.connect(self.add_rect)
+        button_remove_rect = QPushButton('Remove Rect', self)
+        button_remove_rect.clicked.connect(self.remove_rect)
         # config grid
         config_grid = QGridLayout()
         # config_grid.setSpacing(10)
@@ -104,6 +113,8 @@ class CanvasCrop(QWidget):
         # Width  [   ] [   ]  Mode   Combo
         # --------------------------------
         # Rect: Line Width [   ], Color Combo
+        # --------------------------------
+        # Rect list      Add Rect / Remove Rect
         # row 0
         config_grid.addWidget(label_start, 0, 1, 1, 1)
         config_grid.addWidget(label_len, 0, 2, 1, 1)
@@ -127,8 +138,14 @@ class CanvasCrop(QWidget):
         config_grid.addWidget(self.edit_line_width, 4, 1, 1, 1)
         config_grid.addWidget(label_line_color, 4, 2, 1, 1)
         config_grid.addWidget(self.combo_line_color, 4, 3, 1, 1)
+        # row 5: horizontal line
+        config_grid.addWidget(HLine(), 5, 0, 1, 5)
+        # row 6, 7
+        config_grid.addWidget(self.rect_list, 6, 0, 2, 3)
+        config_grid.addWidget(button_add_rect, 6, 3, 1, 2)
+        config_grid.addWidget(button_remove_rect, 7, 3, 1, 2)
         # blank
-        config_grid.addWidget(QLabel(), 5, 0, 5, 5)
+        config_grid.addWidget(QLabel(), 8, 0, 5, 5)
 
         # actions
         button_add = QPushButton('Add ALL', self)
@@ -198,6 +215,31 @@ class CanvasCrop(QWidget):
         self.edit_len_h.setText(str(len_h))
         self.edit_len_w.setText(str(len_w))
 
+    def get_edit_rect(self):
+        """[start_h, start_w, len_h, len_w] in the edits. It raises ValueError for wrong inputs."""
+        rect = [int(edit.text()) for edit in (self.edit_start_h, self.edit_start_w, self.edit_len_h, self.edit_len_w)]
+        if rect[2] <= 0 or rect[3] <= 0:
+            raise ValueError(f'Empty rect {rect}')
+        return rect
+
+    def get_rects(self):
+        """Rects in the rect list, or the rect in the edits if the list is empty."""
+        if self.rect_list.count() == 0:
+            return [self.get_edit_rect()]
+        return [list(map(int, self.rect_list.item(i).text().split(', '))) for i in range(self.rect_list.count())]
+
+    def add_rect(self):
+        try:
+            rect = self.get_edit_rect()
+        except ValueError as error:
+            show_msg(icon='Critical', title='Title', text=f'Wrong input: {error}', timeout=None)
+            return
+        self.rect_list.addItem(', '.join(map(str, rect)))
+
+    def remove_rect(self):
+        for item in self.rect_list.selectedItems():
+            self.rect_list.takeItem(self.rect_list.row(item))
+
     def add_all_images(self):
         self.set_selection_pos()
         # 1. clear all the existing thumbnails
@@ -213,21 +255,20 @@ class CanvasCrop(QWidget):
         self.crop_thumbnails.clear()
         self.rect_thumbnails.clear()
         # 2. add thumbnails
-        for path in sorted(scandir(self.patch_folder, suffix=None, recursive=False, full_path=True)):
-            self.crop_thumbnails.addItem(QListWidgetItem(QIcon(path), os.path.basename(path)))
+        # patch_folder/rect{k}/{folder name}/*_patch.png
+        for path in sorted(scandir(self.patch_folder, suffix=None, recursive=True, full_path=False)):
+            self.crop_thumbnails.addItem(QListWidgetItem(QIcon(os.path.join(self.patch_folder, path)), path))
+        # rect_folder/{folder name}/*_rect.png
         if os.path.isdir(self.rect_folder):
-            for path in sorted(scandir(self.rect_folder, suffix=None, recursive=False, full_path=True)):
-                self.rect_thumbnails.addItem(QListWidgetItem(QIcon(path), os.path.basename(path)))
+            for path in sorted(scandir(self.rect_folder, suffix=None, recursive=True, full_path=False)):
+                self.rect_thumbnails.addItem(QListWidgetItem(QIcon(os.path.join(self.rect_folder, path)), path))
 
     def crop_images(self):
         # 1. check all images has the same shape
         # TODO
         # 2. crop
         try:
-            start_h = int(self.edit_start_h.text())
-            start_w = int(self.edit_start_w.text())
-            len_h = int(self.edit_len_h.text())
-            len_w = int(self.edit_len_w.text())
+            rects = self.get_rects()
             ratio = int(self.edit_ratio.text())
             mode = self.combo_mode.currentText()
             line_width = int(self.edit_line_width.text())
@@ -236,23 +277,49 @@ class CanvasCrop(QWidget):
             show_msg(icon='Critical', title='Title', text=f'Wrong input: {error}', timeout=None)
             return 0
 
-        try:
-            crop_images(
-                self.db.path_list[0], [start_h, start_w, len_h, len_w],
-                self.patch_folder,
-                enlarge_ratio=ratio,
-                interpolation=mode,
-                line_width=line_width,
-                color=line_color,
-                rect_folder=self.rect_folder)
-        except Exception as error:
-            show_msg(icon='Critical', title='Title', text=f'Crop error: {error}', timeout=None)
-        else:
+        if self.crop_worker is not None and self.crop_worker.isRunning():
+            return 0
+        # crop the rects from all the folders in one pass, in a process pool, off the GUI thread
+        path_lists = [list(paths) for paths in self.db.path_list]
+        folders = [
+            folder or (os.path.dirname(paths[0]) if paths else '')
+            for folder, paths in zip(self.db.folder_list, path_lists)
+        ]
+        progress_dialog = QProgressDialog('Cropping ...', 'Cancel', 0, sum(map(len, path_lists)), self)
+        progress_dialog.setWindowTitle('Crop')
+        progress_dialog.setMinimumDuration(500)
+        self.crop_worker = CropWorker(
+            path_lists,
+            rects,
+            self.patch_folder,
+            parent=self,
+            folder_names=get_folder_names(folders),
+            enlarge_ratio=ratio,
+            interpolation=mode,
+            line_width=line_width,
+            color=line_color,
+            rect_folder=self.rect_folder)
+
+        def update_progress(done, total):
+            progress_dialog.setValue(done)
+            progress_dialog.setLabelText(f'Cropping ... {done} / {total}')
+
+        def finish(num, error):
+            progress_dialog.close()
+            if error:
+                show_msg(icon='Critical', title='Title', text=f'Crop error: {error}', timeout=None)
+                return
             # update crop info to txt
-            self.record_crop_history(self.db.path_list[0][0], [start_h, start_w, len_h, len_w], ratio, mode)
+            for rect in rects:
+                self.record_crop_history(path_lists[0][0], rect, ratio, mode)
             # show cropped image
             self.update_crop_rect_images()
 
+        self.crop_worker.progress.connect(update_progress)
+        self.crop_worker.cropped.connect(finish)
+        progress_dialog.canceled.connect(self.crop_worker.cancel)
+        self.crop_worker.start()
+
     def record_crop_history(self, path, pos, ratio, mode):
         pos_str = ', '.join(map(str, pos))
         content = f'{strftime("%Y%m%d-%H%M%S", localtime())} {path} ({pos_str}) {ratio} {mode}\n'
@@ -1,19 +1,61 @@
 from distutils.command.config import config
-import hashlib
 import imagehash
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image, ImageFile
 import json
 import handyview.utils as utils
 import imageio
+import numpy as np
 
-from handyview.utils import FORMATS, ROOT_DIR, get_img_list, scandir, sizeof_fmt
+from handyview.cache_db import HVCache
+from handyview.metrics import get_metric_engine
+from handyview.phash_index import PHashIndex, hash_to_int
+from handyview.utils import (FORMATS, ROOT_DIR, NameFilter, find_insert, find_path, scan_img_list, scan_tree, sizeof_fmt,
+                             tree_key)
 from handyview.widgets import show_msg
 
 # for loading large image file
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 Image.MAX_IMAGE_PIXELS = None
 
+# folders with at least this many images have their listings persisted (see HVDB.scan_folder)
+LISTING_CACHE_MIN_IMAGES = 1000
+
+# metadata record of one image, filled by a single header probe
+# mtime < 0 means not probed yet
+META_DTYPE = np.dtype([('width', np.int32), ('height', np.int32), ('mode', 'U8'), ('size', np.int64),
+                       ('mtime', np.float64)])
+
+
+def new_meta_array(length):
+    meta = np.zeros(length, dtype=META_DTYPE)
+    meta['mtime'] = -1
+    return meta
+
+
+def _delete_items(items, idxs):
+    """A copy of a list without the items at the sorted indices, with slice copies."""
+    result = []
+    start = 0
+    for idx in idxs:
+        result.extend(items[start:idx])
+        start = idx + 1
+    result.extend(items[start:])
+    return result
+
+
+def _insert_items(items, idxs, new_items):
+    """A copy of a list with new_items inserted before the non-decreasing indices, with slice copies."""
+    result = []
+    start = 0
+    for idx, item in zip(idxs, new_items):
+        result.extend(items[start:idx])
+        result.append(item)
+        start = idx
+    result.extend(items[start:])
+    return result
+
 
 class HVDB():
     """HandyView database.
@@ -29,7 +71,10 @@ class HVDB():
         self._include_names = None
         self._exclude_names = None
         self._exact_exclude_names = None
+        # compiled include and exclude rules
+        self.name_filter = NameFilter()
         self._interval = 0  # for compare canvas
+        self._last_step = 1  # the latest browsing step, for prefetching
 
         # whether path lists in compare folders have the same length
         self.is_same_len = True
@@ -38,15 +83,27 @@ class HVDB():
         # list of image path list
         # the first list is the main list
         self.path_list = [[]]
-        self.file_size_list = [[]]
+        # unfiltered image lists of the folders, so that changing the filter does not rescan the folders
+        self.folder_scans = {}
+        # folders whose scans were loaded from the persistent listing cache, to be validated in the background
+        self.unverified_folders = set()
+        # per-folder metadata arrays (META_DTYPE)
+        self.meta_list = [new_meta_array(0)]
         self.md5_list = [[]]
         self.phash_list = [[]]
-        self.psnr_list = [[]]
+        # metric values: {(metric name, base path, base mtime): value} for each image
+        self.metric_list = [[]]
+        # persistent cache for fingerprints and metrics
+        self.cache = HVCache()
+        # near-duplicate search index, rebuilt lazily when phashes change
+        self._phash_index = None
 
         # for selection pos in crop canvas
         self.selection_pos = [0, 0, 0, 0]
 
         self.recursive_scan_folder = False
+        # the rest of a recursive scan, consumed in the background (see ScanWorker)
+        self.pending_scan = None
 
         self.get_init_path_list()
 
@@ -54,10 +111,17 @@ class HVDB():
 
     def get_init_path_list(self):
         """get path list when first launch (double click or from cmd)"""
+        self.pending_scan = None
         # if init_path is a folder, try to get the first image
         if os.path.isdir(self.init_path):
             self.recursive_scan_folder = True
-            self.path_list[0] = list(scandir(self.init_path, suffix=FORMATS, recursive=True, full_path=True))
+            # show the first images as soon as they are found, and leave the rest of the scan in pending_scan
+            scan = scan_tree(self.init_path)
+            self.path_list[0] = next(scan, [])
+            if not self.path_list[0]:
+                show_msg('Critical', 'Critical', f'No image in {self.init_path}')
+                return
+            self.pending_scan = scan
             self.init_path = self.path_list[0][0]
         else:
             self.recursive_scan_folder = False
@@ -70,15 +134,18 @@ class HVDB():
             self.folder_list[0] = folder
             # get path list
             if self.recursive_scan_folder is False:
-                self.path_list[0] = get_img_list(folder, self._include_names, self._exclude_names,
-                                                 self._exact_exclude_names)
-            self.file_size_list[0] = [None] * len(self.path_list[0])
+                self.path_list[0] = self.get_img_list(folder, use_cache=True)
+            self.meta_list[0] = new_meta_array(len(self.path_list[0]))
             self.md5_list[0] = [None] * len(self.path_list[0])
             self.phash_list[0] = [None] * len(self.path_list[0])
-            self.psnr_list[0] = [None] * len(self.path_list[0])
+            self._phash_index = None
+            self.metric_list[0] = [None] * len(self.path_list[0])
             # get current pidx
             try:
-                self._pidx = self.path_list[0].index(self.init_path)
+                if self.recursive_scan_folder:  # not sorted
+                    self._pidx = self.path_list[0].index(self.init_path)
+                else:
+                    self._pidx = find_path(self.path_list[0], self.init_path)
             except ValueError:
                 # self.init_path may not in self.path_list after refreshing
                 self._pidx = 0
@@ -87,6 +154,22 @@ class HVDB():
         else:
             show_msg('Critical', 'Critical', f'Wrong init path! {self.init_path}')
 
+    def add_scanned_paths(self, paths):
+        """Append the images found by the background recursive scan to the main folder."""
+        self.path_list[0].extend(paths)
+        self.meta_list[0] = np.concatenate([self.meta_list[0], new_meta_array(len(paths))])
+        self.md5_list[0].extend([None] * len(paths))
+        self.phash_list[0].extend([None] * len(paths))
+        self._phash_index = None
+        self.metric_list[0].extend([None] * len(paths))
+
+    def finish_scan(self):
+        """Sort the main folder after the recursive scan (by directory, then name), keeping the current image."""
+        current_path = self.get_path(fidx=0)[0]
+        self.remap_path_list(0, sorted(self.path_list[0], key=tree_key))
+        if self._fidx == 0:
+            self._pidx = self.path_list[0].index(current_path)
+
     def save_open_history(self):
         try:
             with open(os.path.join(ROOT_DIR, 'history.txt'), 'r') as f:
@@ -105,7 +188,8 @@ class HVDB():
 
     def path_browse(self, step):
         if self.get_path_len() > 1:
-            self._pidx += step * (self._interval + 1)
+            self._last_step = step * (self._interval + 1)
+            self._pidx += self._last_step
             if self._pidx > (self.get_path_len() - 1):
                 self._pidx = 0
             elif self._pidx < 0:
@@ -127,12 +211,13 @@ class HVDB():
     def add_cmp_folder(self, cmp_path):
         folder = os.path.dirname(cmp_path)
         self.folder_list.append(folder)
-        paths = get_img_list(folder, self._include_names, self._exclude_names, self._exact_exclude_names)
+        paths = self.get_img_list(folder, use_cache=True)
         self.path_list.append(paths)
-        self.file_size_list.append([None] * len(paths))
+        self.meta_list.append(new_meta_array(len(paths)))
         self.md5_list.append([None] * len(paths))
         self.phash_list.append([None] * len(paths))
-        self.psnr_list.append([None] * len(paths))
+        self._phash_index = None
+        self.metric_list.append([None] * len(paths))
         # all the path list should have the same length
         self.is_same_len = True
         img_len_list = [len(self.path_list[0])]
@@ -144,21 +229,89 @@ class HVDB():
 
     def update_com_folder(self, config):
         self.folder_list = [config[k] for k in config.keys() if k.startswith("view")]
-        self.path_list = [get_img_list(folder, self._include_names, self._exclude_names, self._exact_exclude_names) for folder in self.folder_list]
-        self.file_size_list = [[None] * len(paths) for paths in self.path_list]
+        self.path_list = [self.get_img_list(folder, use_cache=True) for folder in self.folder_list]
+        self.meta_list = [new_meta_array(len(paths)) for paths in self.path_list]
         self.md5_list = [[None] * len(paths) for paths in self.path_list]
         self.phash_list = [[None] * len(paths) for paths in self.path_list]
-        self.psnr_list = [[None] * len(paths) for paths in self.path_list]
-
-    def update_path_list(self):
+        self._phash_index = None
+        self.metric_list = [[None] * len(paths) for paths in self.path_list]
+
+    def get_img_list(self, folder, rescan=True, use_cache=False):
+        """Get the filtered image list of a folder.
+
+        Args:
+            folder (str): Folder path.
+            rescan (bool): If False, filter the last scan of the folder, without
+                listing the folder. Default: True.
+            use_cache (bool): When scanning, use the persisted listing if the
+                folder is unchanged (see scan_folder). Default: False.
+        """
+        if rescan or folder not in self.folder_scans:
+            self.folder_scans[folder] = self.scan_folder(folder, use_cache=use_cache or not rescan)
+        return self.name_filter.apply(self.folder_scans[folder])
+
+    def scan_folder(self, folder, use_cache=True):
+        """List all the images in a folder (see utils.scan_img_list), with the persistent listing cache.
+
+        The listings of large folders are persisted with the directory mtime.
+        A persisted listing is used if the mtime is unchanged, and the folder
+        is added to unverified_folders, to be validated by a background rescan.
+        It can run on worker threads when use_cache is False.
+
+        Args:
+            folder (str): Folder path.
+            use_cache (bool): Use the persisted listing if it is valid. Default: True.
+        """
+        scan_path = folder or './'
+        try:
+            mtime = os.stat(scan_path).st_mtime
+        except OSError:
+            return scan_img_list(folder)
+        if use_cache:
+            names = self.cache.get_listing(scan_path, mtime)
+            if names is not None:
+                self.unverified_folders.add(folder)
+                return [os.path.join(scan_path, name).replace('\\', '/') for name in names]
+        img_list = scan_img_list(folder)
+        if len(img_list) >= LISTING_CACHE_MIN_IMAGES:
+            self.cache.set_listing(scan_path, mtime, [path.rpartition('/')[2] for path in img_list])
+        return img_list
+
+    def update_folder_scan(self, folder, img_list):
+        """Replace the scan of a folder, e.g., after a background validation. Return whether it changed.
+
+        Call update_path_list to apply it.
+        """
+        if self.folder_scans.get(folder) == img_list:
+            return False
+        self.folder_scans[folder] = img_list
+        return True
+
+    def update_path_list(self, folders=None, rescan=True):
+        """Rescan (or re-filter) the folders, and apply only the added and removed images.
+
+        The per-file values (meta, fingerprints and metrics) of the unchanged
+        images are kept, and the current image stays selected if it still exists.
+
+        Args:
+            folders (list[str]): Only rescan these folders, e.g., the ones
+                reported by a file system watcher. Default: None (all folders).
+            rescan (bool): If False, only apply the current filter to the last
+                scans, e.g., after changing include names. Default: True.
+
+        Returns:
+            bool: Whether path lists in compare folders have the same length.
+            list[int]: Number of images in each folder.
+        """
         if self.recursive_scan_folder is False:
+            current_path = self.get_path()[0] if self.get_path_len() > 0 else None
             for idx, folder in enumerate(self.folder_list):
-                paths = get_img_list(folder, self._include_names, self._exclude_names, self._exact_exclude_names)
-                self.path_list[idx] = paths
-                self.file_size_list[idx] = [None] * len(paths)
-                self.md5_list[idx] = [None] * len(paths)
-                self.phash_list[idx] = [None] * len(paths)
-                self.psnr_list[idx] = [None] * len(paths)
+                if folders is None or folder in folders:
+                    self.remap_path_list(idx, self.get_img_list(folder, rescan))
+            # forget the folders no longer shown
+            self.folder_scans = {folder: self.folder_scans[folder] for folder in self.folder_list
+                                 if folder in self.folder_scans}
+            self._select_path(current_path)
 
         # all the path list should have the same length
         self.is_same_len = True
@@ -169,6 +322,108 @@ class HVDB():
                 self.is_same_len = False
         return self.is_same_len, img_len_list
 
+    def _select_path(self, current_path):
+        """Keep the current image after the path lists changed, or the nearest index if it was removed."""
+        paths = self.path_list[self._fidx]
+        pidx = None
+        if current_path is not None:  # None if the folder was empty
+            try:
+                pidx = find_path(paths, current_path)
+            except ValueError:
+                pass
+        self._pidx = max(min(self._pidx, len(paths) - 1), 0) if pidx is None else pidx
+
+    def apply_folder_scan(self, folder, old_scan, img_list, added, removed):
+        """Apply a background rescan of a folder (see workers.ListingWorker), touching only the changed images.
+
+        Call update_path_list(folders=[], rescan=False) afterwards for the lengths of the path lists.
+
+        Args:
+            folder (str): Folder path.
+            old_scan (list[str]): The scan of the folder that the rescan was compared with.
+            img_list (list[str]): The new scan.
+            added (list[str]): Images of img_list not in old_scan, in order.
+            removed (list[str]): Images of old_scan not in img_list.
+
+        Returns:
+            bool: Whether the path lists changed.
+        """
+        if self.recursive_scan_folder is not False or folder not in self.folder_list:
+            return False
+        if self.folder_scans.get(folder) is not old_scan:
+            # the folder was scanned again meanwhile, the diff does not apply
+            if not self.update_folder_scan(folder, img_list):
+                return False
+            self.update_path_list(folders=[folder], rescan=False)
+            return True
+        if not added and not removed:
+            return False
+        self.folder_scans[folder] = img_list
+        current_path = self.get_path()[0] if self.get_path_len() > 0 else None
+        added = self.name_filter.apply(added)
+        for fidx, shown_folder in enumerate(self.folder_list):
+            if shown_folder == folder:
+                self.patch_path_list(fidx, added, removed)
+        self._select_path(current_path)
+        return True
+
+    def patch_path_list(self, fidx, added, removed):
+        """Insert and remove images in the path list of a folder, keeping the per-file values of the others.
+
+        Unlike remap_path_list, only the changed images are searched (with binary search).
+        """
+        paths = self.path_list[fidx]
+        remove_idxs = []
+        for path in removed:
+            try:
+                remove_idxs.append(find_path(paths, path))
+            except ValueError:  # e.g., filtered out
+                pass
+        remove_idxs.sort()
+        values = [paths, self.md5_list[fidx], self.phash_list[fidx], self.metric_list[fidx]]
+        if remove_idxs:
+            values = [_delete_items(items, remove_idxs) for items in values]
+            paths = values[0]
+        # insert positions are in the list without the removed images; added is in order, so they do not decrease
+        insert_idxs = [find_insert(paths, path) for path in added]
+        if insert_idxs:
+            values = [_insert_items(items, insert_idxs, new_items)
+                      for items, new_items in zip(values, [added] + [[None] * len(added)] * 3)]
+        meta = np.delete(self.meta_list[fidx], remove_idxs)
+        self.meta_list[fidx] = np.insert(meta, insert_idxs, new_meta_array(len(insert_idxs)))
+        self.path_list[fidx], self.md5_list[fidx], self.phash_list[fidx], self.metric_list[fidx] = values
+        self._phash_index = None
+
+    def remap_path_list(self, fidx, paths):
+        """Replace the path list of a folder, moving the per-file values of the kept images to their new indices.
+
+        Returns:
+            bool: Whether the path list has changed.
+        """
+        old_paths = self.path_list[fidx]
+        if paths == old_paths:
+            return False
+        old_index = {path: idx for idx, path in enumerate(old_paths)}
+        kept = [(idx, old_index[path]) for idx, path in enumerate(paths) if path in old_index]
+        meta = new_meta_array(len(paths))
+        md5 = [None] * len(paths)
+        phash = [None] * len(paths)
+        metric = [None] * len(paths)
+        if kept:
+            new_idx, old_idx = (list(v) for v in zip(*kept))
+            meta[new_idx] = self.meta_list[fidx][old_idx]
+            for new, old in kept:
+                md5[new] = self.md5_list[fidx][old]
+                phash[new] = self.phash_list[fidx][old]
+                metric[new] = self.metric_list[fidx][old]
+        self.path_list[fidx] = paths
+        self.meta_list[fidx] = meta
+        self.md5_list[fidx] = md5
+        self.phash_list[fidx] = phash
+        self.metric_list[fidx] = metric
+        self._phash_index = None
+        return True
+
     def get_folder(self, folder=None, fidx=None):
         if folder is None:
             if fidx is None:
@@ -193,57 +448,314 @@ class HVDB():
         path = self.path_list[fidx][pidx]
         return path, fidx, pidx
 
-    def get_shape(self, fidx=None, pidx=None):
-        path = self.get_path(fidx, pidx)[0]
+    def get_meta(self, fidx=None, pidx=None):
+        """Get the metadata record (width, height, mode, size, mtime) of an image.
+
+        The record is probed once (a stat and an image header read) and
+        re-probed only when the file mtime changes.
+        """
+        path, fidx, pidx = self.get_path(fidx, pidx)
+        meta = self.meta_list[fidx][pidx]
         try:
-            with Image.open(path) as lazy_img:
-                width, height = lazy_img.size
+            stat = os.stat(path)
+            if meta['mtime'] != stat.st_mtime:
+                if meta['mtime'] >= 0:
+                    # the file has been modified, drop the outdated values
+                    self.md5_list[fidx][pidx] = None
+                    self.phash_list[fidx][pidx] = None
+                    self.metric_list[fidx][pidx] = None
+                with Image.open(path) as lazy_img:
+                    width, height = lazy_img.size
+                    mode = lazy_img.mode
+                self.meta_list[fidx][pidx] = (width, height, mode, stat.st_size, stat.st_mtime)
+                meta = self.meta_list[fidx][pidx]
         except FileNotFoundError:
             show_msg('Critical', 'Critical', f'Cannot open {path}')
-        return width, height
+        return meta
+
+    def get_shape(self, fidx=None, pidx=None):
+        meta = self.get_meta(fidx, pidx)
+        return int(meta['width']), int(meta['height'])
 
     def get_color_type(self, fidx=None, pidx=None):
-        path = self.get_path(fidx, pidx)[0]
-        try:
-            with Image.open(path) as lazy_img:
-                color_type = lazy_img.mode
-        except FileNotFoundError:
-            show_msg('Critical', 'Critical', f'Cannot open {path}')
-        return color_type
+        return str(self.get_meta(fidx, pidx)['mode'])
 
     def get_file_size(self, fidx=None, pidx=None):
-        path, fidx, pidx = self.get_path(fidx, pidx)
-        file_size = self.file_size_list[fidx][pidx]
-        if file_size is None:
-            file_size = sizeof_fmt(os.path.getsize(path))
-            self.file_size_list[fidx][pidx] = file_size
-        return file_size
+        return sizeof_fmt(int(self.get_meta(fidx, pidx)['size']))
 
-    def get_fingerprint(self, fidx=None, pidx=None):
+    def get_fingerprint(self, fidx=None, pidx=None, compute=True, progress=None):
+        """Get (md5, phash) of an image.
+
+        Args:
+            compute (bool): If False, only return the cached values, and the
+                missing ones are None. Default: True.
+            progress (func): Called with (done_bytes, total_bytes) while
+                hashing. Default: None.
+        """
         path, fidx, pidx = self.get_path(fidx, pidx)
-        # md5
+        meta = self.get_meta(fidx, pidx)
+        size, mtime = int(meta['size']), float(meta['mtime'])
         md5 = self.md5_list[fidx][pidx]
-        if md5 is None:
-            data = open(path, 'rb').read()
-            md5 = hashlib.md5(data).hexdigest()
-            self.md5_list[fidx][pidx] = md5
-        # phash (perceptual hash)
         phash = self.phash_list[fidx][pidx]
-        if phash is None:
-            phash = imagehash.phash(Image.open(path))
+        if md5 is None or phash is None:
+            # try the persistent cache first
+            md5_cached, phash_cached = self.cache.get_fingerprint(path, size, mtime)
+            if md5 is None:
+                md5 = md5_cached
+            if phash is None and phash_cached is not None:
+                phash = imagehash.hex_to_hash(phash_cached)
+            if self.phash_list[fidx][pidx] is None and phash is not None:
+                self._phash_index = None
+            self.md5_list[fidx][pidx] = md5
+            self.phash_list[fidx][pidx] = phash
+            if not compute:
+                return (md5, phash)
+            # md5
+            if md5 is None:
+                md5 = utils.md5sum(path, progress=progress)
+            # phash (perceptual hash)
+            if phash is None:
+                with Image.open(path) as img:
+                    phash = imagehash.phash(img)
+            if md5_cached is None or phash_cached is None:
+                self.cache.set_fingerprint(path, size, mtime, md5, phash)
+            if self.phash_list[fidx][pidx] is None:
+                self._phash_index = None
+            self.md5_list[fidx][pidx] = md5
             self.phash_list[fidx][pidx] = phash
         return (md5, phash)
 
+    def set_fingerprint(self, fidx, pidx, path, md5, phash):
+        """Store a fingerprint computed in the background. It must be called on the GUI thread.
+
+        Args:
+            phash (str): Hex string of the phash.
+
+        Returns:
+            bool: False if (fidx, pidx) is no longer path (e.g., after a refresh), and nothing is stored.
+        """
+        if fidx >= len(self.path_list) or pidx >= len(self.path_list[fidx]) or self.path_list[fidx][pidx] != path:
+            return False
+        if self.phash_list[fidx][pidx] is None:
+            self._phash_index = None
+        self.md5_list[fidx][pidx] = md5
+        self.phash_list[fidx][pidx] = imagehash.hex_to_hash(phash)
+        return True
+
+    def build_index(self, num_workers=None, progress=None, is_cancelled=None):
+        """Compute the fingerprints of all the images in all the folders.
+
+        Values already in memory or in the persistent cache are reused, and
+        the others are computed in a process pool. It runs the three steps
+        get_index_jobs, compute_fingerprints and merge_fingerprints in turn;
+        in the GUI, compute_fingerprints runs on IndexWorker instead.
+
+        Args:
+            num_workers (int): Number of processes. Default: None (number of CPUs).
+            progress (func): Called with (done, total) images. Default: None.
+            is_cancelled (func): Return True to stop. Default: None.
+
+        Returns:
+            int: Number of indexed images.
+        """
+        jobs, done, total = self.get_index_jobs()
+        results = self.compute_fingerprints(jobs, done, total, num_workers, progress, is_cancelled)
+        return done + self.merge_fingerprints(results)
+
+    def get_index_jobs(self):
+        """List the images without fingerprints in memory. It only reads the path lists, so it is cheap.
+
+        Returns:
+            list[tuple]: Jobs (fidx, pidx, path).
+            int: Number of images with fingerprints.
+            int: Number of images.
+        """
+        jobs = [(fidx, pidx, path) for fidx, paths in enumerate(self.path_list) for pidx, path in enumerate(paths)
+                if self.md5_list[fidx][pidx] is None or self.phash_list[fidx][pidx] is None]
+        total = sum(len(paths) for paths in self.path_list)
+        return jobs, total - len(jobs), total
+
+    def compute_fingerprints(self, jobs, done=0, total=None, num_workers=None, progress=None, is_cancelled=None):
+        """Get the fingerprints of the jobs from get_index_jobs.
+
+        They are read from the persistent cache if the files are unchanged,
+        and the others are computed in a process pool. It only reads the files
+        and the persistent cache (and writes it), so it can run on worker threads.
+
+        Args:
+            done (int): Number of images already done, for progress. Default: 0.
+            total (int): Number of images, for progress. Default: None (number of jobs).
+
+        Returns:
+            list[tuple]: (fidx, pidx, path, md5, phash hex string) of the cached and computed images.
+        """
+        if total is None:
+            total = done + len(jobs)
+        if progress is not None:
+            progress(done, total)
+        results = []
+        compute_jobs = []
+        for num, (fidx, pidx, path) in enumerate(jobs, 1):
+            if is_cancelled is not None and is_cancelled():
+                return results
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            md5, phash = self.cache.get_fingerprint(path, stat.st_size, stat.st_mtime)
+            if md5 is not None and phash is not None:
+                results.append((fidx, pidx, path, md5, phash))
+                done += 1
+            else:
+                compute_jobs.append((fidx, pidx, path, stat.st_size, stat.st_mtime))
+            if progress is not None and num % 1000 == 0:
+                progress(done, total)
+        if progress is not None:
+            progress(done, total)
+        if not compute_jobs:
+            return results
+
+        rows = []
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = {executor.submit(utils.compute_fingerprint, job[2]): job for job in compute_jobs}
+            for future in as_completed(futures):
+                if is_cancelled is not None and is_cancelled():
+                    for f in futures:
+                        f.cancel()
+                    break
+                fidx, pidx, path, size, mtime = futures[future]
+                try:
+                    md5, phash = future.result()
+                except Exception as error:
+                    print(f'Fingerprint error for {path}: {error}')
+                    continue
+                results.append((fidx, pidx, path, md5, phash))
+                rows.append((path, size, mtime, md5, phash))
+                if len(rows) >= 256:
+                    self.cache.set_fingerprints(rows)
+                    rows = []
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+        self.cache.set_fingerprints(rows)
+        return results
+
+    def merge_fingerprints(self, results):
+        """Store the results of compute_fingerprints by path. It must be called on the GUI thread.
+
+        Images that have moved (e.g., after a refresh) are looked up by path,
+        and the removed ones are skipped.
+
+        Returns:
+            int: Number of stored results.
+        """
+        num = 0
+        locations = None  # path: (fidx, pidx), built on the first moved image
+        for fidx, pidx, path, md5, phash in results:
+            if not self.set_fingerprint(fidx, pidx, path, md5, phash):
+                if locations is None:
+                    locations = {p: (f, i) for f, paths in enumerate(self.path_list) for i, p in enumerate(paths)}
+                if path not in locations:
+                    continue
+                self.set_fingerprint(*locations[path], path, md5, phash)
+            num += 1
+        return num
+
+    def get_phash_index(self):
+        """Get the near-duplicate index over all the known phashes."""
+        if self._phash_index is None:
+            hashes, keys = [], []
+            for fidx, phashes in enumerate(self.phash_list):
+                for pidx, phash in enumerate(phashes):
+                    if phash is not None:
+                        hashes.append(hash_to_int(phash))
+                        keys.append((fidx, pidx))
+            self._phash_index = PHashIndex(hashes, keys)
+        return self._phash_index
+
+    def find_similar(self, max_dist, fidx=None, pidx=None):
+        """Find images within phash Hamming distance max_dist of an image.
+
+        Only images with known phashes (see build_index) are searched.
+
+        Returns:
+            list[tuple]: (distance, fidx, pidx), sorted by distance.
+        """
+        _, fidx, pidx = self.get_path(fidx, pidx)
+        phash = self.get_fingerprint(fidx, pidx)[1]
+        results = self.get_phash_index().query(hash_to_int(phash), max_dist)
+        return [(dist, key[0], key[1]) for dist, key in results if key != (fidx, pidx)]
+
     def get_metric(self, base_fidx, comp_fidx):
-        path, fidx, pidx = self.get_path(fidx=comp_fidx)
+        return self.get_metrics(base_fidx, [comp_fidx])[0]
+
+    def get_metrics(self, base_fidx, comp_fidx_list, names=None):
+        """Get the metrics of several compare folders against the base folder.
+
+        Values are cached in memory per compare image, keyed by (metric, base
+        path, base mtime), so they stay valid when a refresh moves the images
+        of any folder, and in the persistent cache. The missing values are computed together by the
+        metric engine, which decodes the base image once and evaluates the
+        folders in parallel.
+
+        Args:
+            names (list[str]): Metric names in METRIC_REGISTRY. Default: None
+                (the metrics in the compare config).
+
+        Returns:
+            list[dict]: Metrics for each compare folder.
+        """
+        if names is None:
+            names = self.metric_names
         base_path, base_fidx, base_pidx = self.get_path(fidx=base_fidx)
-        # PSNR
-        psnr = self.psnr_list[fidx][pidx]
-        if psnr is None and base_path != path:
-            psnr = utils.cal_psnr(base_path, path)
-            self.psnr_list[fidx][pidx] = psnr
-        # Others to be supplemented
-        return {"PSNR": psnr}
+        base_meta = self.get_meta(base_fidx, base_pidx)
+        base_mtime = float(base_meta['mtime'])
+        results = [{} for _ in comp_fidx_list]
+        jobs = []  # (idx, fidx, pidx, path, cache key, missing names)
+        for idx, comp_fidx in enumerate(comp_fidx_list):
+            path, fidx, pidx = self.get_path(fidx=comp_fidx)
+            if base_path == path:
+                results[idx] = {name: None for name in names}
+                continue
+            values = self.metric_list[fidx][pidx]
+            if values is None:
+                values = self.metric_list[fidx][pidx] = {}
+            key = None
+            missing = []
+            for name in names:
+                value = values.get((name, base_path, base_mtime))
+                if value is None:
+                    if key is None:
+                        meta = self.get_meta(fidx, pidx)
+                        key = (path, int(meta['size']), float(meta['mtime']), base_path, int(base_meta['size']),
+                               base_mtime)
+                    value = self.cache.get_metric(name, *key)
+                    if value is None:
+                        missing.append(name)
+                    else:
+                        values[(name, base_path, base_mtime)] = value
+                results[idx][name] = value
+            if missing:
+                jobs.append((idx, fidx, pidx, path, key, missing))
+        if jobs:
+            missing_names = list(dict.fromkeys(name for job in jobs for name in job[5]))
+            computed = get_metric_engine().compute(base_path, [job[3] for job in jobs], missing_names)
+            for (idx, fidx, pidx, _, key, missing), values in zip(jobs, computed):
+                for name in missing:
+                    value = values.get(name)
+                    if value is not None:
+                        self.cache.set_metric(name, *key, value)
+                        self.metric_list[fidx][pidx][(name, base_path, base_mtime)] = value
+                    results[idx][name] = value
+        return results
+
+    @property
+    def metric_names(self):
+        return self.compare_config.get('metrics', ['PSNR'])
+
+    @metric_names.setter
+    def metric_names(self, value):
+        self.compare_config['metrics'] = value
 
     def get_folder_len(self):
         return len(self.folder_list)
@@ -279,6 +791,10 @@ class HVDB():
         else:
             self._pidx = value
 
+    @property
+    def last_step(self):
+        return self._last_step
+
     @property
     def include_names(self):
         return self._include_names
@@ -286,7 +802,7 @@ class HVDB():
     @include_names.setter
     def include_names(self, value):
         self._include_names = value
-        # TODO: move check from handyviewer.py here
+        self.update_name_filter()
 
     @property
     def exclude_names(self):
@@ -295,7 +811,7 @@ class HVDB():
     @exclude_names.setter
     def exclude_names(self, value):
         self._exclude_names = value
-        # TODO: move check from handyviewer.py here
+        self.update_name_filter()
 
     @property
     def exact_exclude_names(self):
@@ -304,6 +820,11 @@ class HVDB():
     @exact_exclude_names.setter
     def exact_exclude_names(self, value):
         self._exact_exclude_names = value
+        self.update_name_filter()
+
+    def update_name_filter(self):
+        """Compile the include and exclude names. Raise re.error for invalid regex rules."""
+        self.name_filter = NameFilter(self._include_names, self._exclude_names, self._exact_exclude_names)
 
     @property
     def interval(self):
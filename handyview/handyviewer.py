@@ -1,9 +1,11 @@
 import os
+import re
 import sys
 from PyQt5 import QtCore
+from PyQt5.QtCore import QFileSystemWatcher, QTimer
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import (QApplication, QDockWidget, QFileDialog, QGridLayout, QInputDialog, QLabel, QLineEdit,
-                             QMainWindow, QTabWidget, QToolBar, QVBoxLayout, QWidget)
+                             QMainWindow, QProgressDialog, QTabWidget, QToolBar, QVBoxLayout, QWidget)
 
 import handyview.actions as actions
 from handyview.canvas import Canvas
@@ -11,9 +13,15 @@ from handyview.mag_canvas import MagCanvas
 from handyview.canvas_crop import CanvasCrop
 from handyview.canvas_video import CanvasVideo
 from handyview.db import HVDB
+from handyview.metrics import METRIC_REGISTRY
 from handyview.utils import ROOT_DIR
-import handyview.utils as utils
-from handyview.widgets import HLine, MessageDialog, show_msg, CompareSettingEdit
+import handyview.video_export as video_export
+from handyview.widgets import HLine, MessageDialog, show_msg, CompareSettingEdit, ExportVideoSetting
+from handyview.workers import IndexWorker, ListingWorker, ScanWorker, get_export_worker
+
+# delay (ms) from the last change in a watched folder to its refresh
+FOLDER_REFRESH_DELAY = 500
+NAME_RULES_HINT = 'Key word (seprate by ,; join by & for AND; glob: *, ?; regex: re:...):'
 
 
 class Application(QApplication):
@@ -96,6 +104,30 @@ class MainWindow(QMainWindow):
         self.full_screen = False
         self.canvas_type = 'main'
         self.center_canvas = CenterWidget(self, self.hvdb)
+        # video exports queued from this window, see add_export_job
+        self.export_jobs = []
+        self.running_export = None
+        self.export_progress = None
+        self.resume_frames = {}  # video path: the first frame not exported yet
+        # watch the shown folders, and refresh the changed ones (e.g., a training job writing new images)
+        self.folder_watcher = QFileSystemWatcher(self)
+        self.folder_watcher.directoryChanged.connect(self.on_folder_changed)
+        self.changed_folders = set()  # kept until the main canvas is shown
+        self.refresh_worker = None
+        # a burst of changes is applied in one refresh
+        self.folder_refresh_timer = QTimer(self)
+        self.folder_refresh_timer.setSingleShot(True)
+        self.folder_refresh_timer.setInterval(FOLDER_REFRESH_DELAY)
+        self.folder_refresh_timer.timeout.connect(self.refresh_changed_folders)
+        self.watch_folders()
+        # the rest of a recursive folder scan
+        self.scan_worker = None
+        self.start_scan()
+        # rescan the folders whose listings were loaded from the cache
+        self.listing_worker = None
+        self.validate_listings()
+        # the fingerprint index, see build_index
+        self.index_worker = None
 
         # initialize UI
         # read version from file
@@ -134,6 +166,9 @@ class MainWindow(QMainWindow):
         compare_menu.addAction(actions.compare(self))
         compare_menu.addAction(actions.clear_compare(self))
         compare_menu.addAction(actions.set_fingerprint(self))
+        compare_menu.addAction(actions.build_index(self))
+        compare_menu.addAction(actions.find_similar(self))
+        compare_menu.addAction(actions.set_metrics(self))
 
         # Layouts
         layout_menu = menubar.addMenu('&Layout(布局)')
@@ -241,7 +276,7 @@ class MainWindow(QMainWindow):
         layout.addWidget(HLine(), 8, 0, 1, 3)
         layout.addWidget(self.center_canvas.canvas.comparison_label, 9, 0, 1, 3)
         # update comparison info (for a second open)
-        _, img_len_list = self.hvdb.update_path_list()
+        _, img_len_list = self.hvdb.update_path_list(rescan=False)
         show_str = 'Comparison:\n # for each folder:\n\t' + '\n\t'.join(map(str, img_len_list))
         if len(img_len_list) > 1:
             self.center_canvas.canvas.comparison_label.setText(show_str)
@@ -274,6 +309,9 @@ class MainWindow(QMainWindow):
             if ok:
                 self.hvdb.init_path = key
                 self.hvdb.get_init_path_list()
+                self.start_scan()
+                self.watch_folders()
+                self.validate_listings()
                 self.center_canvas.canvas.show_image(init=True)
                 self.center_canvas.canvas_crop.update_db(self.hvdb)
         self.empty = False
@@ -286,10 +324,69 @@ class MainWindow(QMainWindow):
         if ok:
             self.hvdb.init_path = key
             self.hvdb.get_init_path_list()
+            self.start_scan()
+            self.watch_folders()
+            self.validate_listings()
             self.center_canvas.canvas.show_image(init=True)
             self.center_canvas.canvas_crop.update_db(self.hvdb)
         self.empty = False
 
+    def start_scan(self):
+        """Fill the main folder with the rest of a recursive folder scan in the background."""
+        if self.scan_worker is not None:
+            # the previous folder is no longer shown
+            self.scan_worker.cancel()
+            self.scan_worker = None
+        if self.hvdb.pending_scan is None:
+            return
+        self.scan_worker = ScanWorker(self.hvdb.pending_scan, self)
+        self.hvdb.pending_scan = None
+        self.scan_worker.found.connect(self.on_scan_found)
+        self.scan_worker.scanned.connect(self.on_scanned)
+        self.scan_worker.start()
+
+    def on_scan_found(self, paths):
+        if self.sender() is not self.scan_worker:  # from a cancelled scan
+            return
+        self.hvdb.add_scanned_paths(paths)
+        self.set_statusbar(f'Scanning: {self.hvdb.get_path_len(0)} images found...')
+
+    def on_scanned(self):
+        if self.sender() is not self.scan_worker:
+            return
+        self.scan_worker = None
+        self.hvdb.finish_scan()
+        if isinstance(self.center_canvas.canvas, Canvas):
+            self.center_canvas.canvas.show_image(init=False)
+
+    def validate_listings(self):
+        """Rescan the folders loaded from the persistent listing cache in the background."""
+        folders = [folder for folder in self.hvdb.unverified_folders if folder in self.hvdb.folder_list]
+        self.hvdb.unverified_folders.clear()
+        if not folders:
+            return
+        self.listing_worker = ListingWorker(self.hvdb, folders, self)
+        self.listing_worker.scanned.connect(self.on_listing_validated)
+        self.listing_worker.start()
+
+    def on_listing_validated(self, folder, old_scan, img_list, added, removed):
+        # the folder changed while HandyView was closed, but kept its mtime (e.g., NFS)
+        self.apply_folder_scan(folder, old_scan, img_list, added, removed)
+
+    def apply_folder_scan(self, folder, old_scan, img_list, added, removed):
+        """Apply the added and removed images of a background rescan (see ListingWorker)."""
+        if not self.hvdb.apply_folder_scan(folder, old_scan, img_list, added, removed):
+            return
+        canvas = self.center_canvas.canvas
+        if isinstance(canvas, Canvas):
+            # no folder is rescanned, it only updates the comparison info
+            canvas.update_path_list(folders=[], warn=False, rescan=False)
+            # a compare folder may be empty for a while, e.g., before a job writes its first image
+            if all(len(paths) > 0 for paths in self.hvdb.path_list):
+                canvas.show_image(init=False)
+        else:
+            self.hvdb.update_path_list(folders=[], rescan=False)
+
     # ---------------------------------------
     # slots: refresh and index
     # ---------------------------------------
@@ -300,6 +397,49 @@ class MainWindow(QMainWindow):
 
         self.center_canvas.canvas.update_path_list()
         self.center_canvas.canvas.show_image(init=False)
+        self.watch_folders()
+
+    def watch_folders(self):
+        """Watch the folders in the database (except the recursively scanned ones)."""
+        watched = self.folder_watcher.directories()
+        if watched:
+            self.folder_watcher.removePaths(watched)
+        if not self.hvdb.recursive_scan_folder:
+            folders = [folder for folder in dict.fromkeys(self.hvdb.folder_list) if folder and os.path.isdir(folder)]
+            if folders:
+                self.folder_watcher.addPaths(folders)
+
+    def on_folder_changed(self, folder):
+        self.changed_folders.add(folder)
+        self.folder_refresh_timer.start()
+
+    def refresh_changed_folders(self):
+        """Rescan the changed folders in the background, and apply their added and removed images."""
+        if not isinstance(self.center_canvas.canvas, Canvas):
+            # e.g., the magnification canvas: the folders stay pending until the main canvas is shown
+            return
+        if self.refresh_worker is not None:  # refreshed again when it finishes
+            return
+        folders = [folder for folder in self.changed_folders if folder in self.hvdb.folder_list]
+        self.changed_folders = set()
+        if not folders:
+            return
+        self.refresh_worker = ListingWorker(self.hvdb, folders, self)
+        self.refresh_worker.scanned.connect(self.on_folder_rescanned)
+        self.refresh_worker.finished.connect(self.on_refresh_finished)
+        self.refresh_worker.start()
+
+    def on_folder_rescanned(self, folder, old_scan, img_list, added, removed):
+        if self.sender() is not self.refresh_worker:
+            return
+        self.apply_folder_scan(folder, old_scan, img_list, added, removed)
+
+    def on_refresh_finished(self):
+        if self.sender() is not self.refresh_worker:
+            return
+        self.refresh_worker = None
+        if self.changed_folders:
+            self.folder_refresh_timer.start()
 
     def goto_index(self):
         index, ok = QInputDialog.getText(self, 'Go to index', 'Index:', QLineEdit.Normal, '1')
@@ -323,15 +463,13 @@ class MainWindow(QMainWindow):
         else:
             current_include_names = ', '.join(current_include_names)
 
-        include_names, ok = QInputDialog.getText(self, 'Include file name', 'Key word (seprate by ,):',
-                                                 QLineEdit.Normal, current_include_names)
+        include_names, ok = QInputDialog.getText(self, 'Include file name', NAME_RULES_HINT, QLineEdit.Normal,
+                                                 current_include_names)
         if ok:
             if include_names != '':
-                self.hvdb.include_names = [v.strip() for v in include_names.split(',')]
-                self.hvdb.exclude_names = None
+                self.set_name_rules([v.strip() for v in include_names.split(',')], None)
             else:
-                self.hvdb.include_names = None
-            self.refresh_img_list()
+                self.set_name_rules(None, self.hvdb.exclude_names)
 
     def exclude_file_name(self):
         # show current exclude names as the default values
@@ -341,15 +479,31 @@ class MainWindow(QMainWindow):
         else:
             current_exclude_names = ', '.join(current_exclude_names)
 
-        exclude_names, ok = QInputDialog.getText(self, 'Exclude file name', 'Key word (seprate by ,):',
-                                                 QLineEdit.Normal, current_exclude_names)
+        exclude_names, ok = QInputDialog.getText(self, 'Exclude file name', NAME_RULES_HINT, QLineEdit.Normal,
+                                                 current_exclude_names)
         if ok:
             if exclude_names != '':
-                self.hvdb.exclude_names = [v.strip() for v in exclude_names.split(',')]
-                self.hvdb.include_names = None
+                self.set_name_rules(None, [v.strip() for v in exclude_names.split(',')])
             else:
-                self.hvdb.exclude_names = None
-            self.refresh_img_list()
+                self.set_name_rules(self.hvdb.include_names, None)
+
+    def set_name_rules(self, include_names, exclude_names):
+        """Apply include and exclude names by re-filtering the scanned folders, without rescanning them."""
+        old_names = (self.hvdb.include_names, self.hvdb.exclude_names)
+        try:
+            self.hvdb.include_names, self.hvdb.exclude_names = include_names, exclude_names
+        except re.error as error:
+            self.hvdb.include_names, self.hvdb.exclude_names = old_names
+            show_msg('Critical', 'Error!', f'Invalid regex: {error}')
+            return
+        if self.canvas_type != 'main':
+            self.switch_main_canvas()
+        self.center_canvas.canvas.update_path_list(rescan=False)
+        if self.hvdb.get_path_len() == 0:
+            self.hvdb.include_names, self.hvdb.exclude_names = old_names
+            self.center_canvas.canvas.update_path_list(rescan=False)
+            show_msg('Warning', 'Warning!', 'No image matches the names.')
+        self.center_canvas.canvas.show_image(init=False)
 
     # ---------------------------------------
     # slots: compare and clear compare
@@ -364,6 +518,8 @@ class MainWindow(QMainWindow):
         key, ok = QFileDialog.getOpenFileName(self, 'Select an image', os.path.join(self.hvdb.get_folder(), '../'))
         if ok:
             self.center_canvas.canvas.add_cmp_folder(key)
+            self.watch_folders()
+            self.validate_listings()
 
     def clear_compare(self):
         # Compare folder should be set in Main Cavans
@@ -375,12 +531,15 @@ class MainWindow(QMainWindow):
         self.hvdb.fidx = 0
         # clear the text description in the dock window
         self.center_canvas.canvas.update_path_list()
+        self.watch_folders()
 
     def compare_setting(self):
         compare_setting_box = CompareSettingEdit(self.hvdb.compare_config)
         compare_setting_box.save_button.clicked.connect(
             lambda: self.hvdb.update_compare_config(compare_setting_box.exportConfig())
             )
+        compare_setting_box.save_button.clicked.connect(self.watch_folders)
+        compare_setting_box.save_button.clicked.connect(self.validate_listings)
         compare_setting_box.save_button.clicked.connect(compare_setting_box.accept)
         compare_setting_box.exec_()
 
@@ -396,6 +555,9 @@ class MainWindow(QMainWindow):
             self.setCentralWidget(self.center_canvas)
             self.add_dock_window()
             self.canvas_type = 'main'
+            # the folders changed while another canvas was shown
+            if self.changed_folders:
+                self.folder_refresh_timer.start()
 
     def switch_compare_canvas(self):
         if self.canvas_type != 'compare' or True:
@@ -468,6 +630,51 @@ class MainWindow(QMainWindow):
             self.center_canvas.canvas.show_fingerprint = True
         self.center_canvas.canvas.show_image()
 
+    def build_index(self):
+        if self.index_worker is not None and self.index_worker.isRunning():
+            return
+        progress_dialog = QProgressDialog('Building fingerprint index ...', 'Cancel', 0, 100, self)
+        progress_dialog.setWindowTitle('Build Index')
+        progress_dialog.setMinimumDuration(0)
+        jobs, done, total = self.hvdb.get_index_jobs()
+        self.index_worker = IndexWorker(self.hvdb, jobs, done, total, self)
+
+        def update_progress(done, total):
+            progress_dialog.setMaximum(max(total, 1))
+            progress_dialog.setValue(done)
+            progress_dialog.setLabelText(f'Building fingerprint index ... {done} / {total}')
+
+        def finish(results):
+            num = done + self.hvdb.merge_fingerprints(results)
+            progress_dialog.close()
+            self.set_statusbar(f'Fingerprint index: {num} images.')
+            self.center_canvas.canvas.show_image()
+
+        self.index_worker.progress.connect(update_progress)
+        self.index_worker.indexed.connect(finish)
+        progress_dialog.canceled.connect(self.index_worker.cancel)
+        self.index_worker.start()
+
+    def find_similar(self):
+        max_dist, ok = QInputDialog.getInt(self, 'Find Similar', 'Max phash distance:', 4, 0, 64)
+        if not ok:
+            return
+        results = self.hvdb.find_similar(max_dist)
+        if not results:
+            show_msg('Information', 'Find Similar', ('No similar image found.\n'
+                                                     'Use Build Index to search in all the images.'))
+            return
+        items = []
+        for dist, fidx, pidx in results:
+            path = self.hvdb.get_path(fidx, pidx)[0]
+            items.append(f'[{dist}] {pidx + 1}: {path}')
+        key, ok = QInputDialog().getItem(self, 'Find Similar', f'{len(results)} similar images:', items, 0, False)
+        if ok:
+            _, fidx, pidx = results[items.index(key)]
+            self.hvdb.fidx = fidx
+            self.hvdb.pidx = pidx
+            self.center_canvas.canvas.show_image()
+
     def cal_metric(self):
         if self.center_canvas.canvas.show_metric:
             self.center_canvas.canvas.show_metric = False
@@ -475,6 +682,20 @@ class MainWindow(QMainWindow):
             self.center_canvas.canvas.show_metric = True
         self.center_canvas.canvas.show_image()
 
+    def set_metrics(self):
+        names, ok = QInputDialog.getText(self, 'Set Metrics',
+                                         'Metrics (seprate by ,):\n' + ', '.join(METRIC_REGISTRY.keys()),
+                                         QLineEdit.Normal, ', '.join(self.hvdb.metric_names))
+        if ok:
+            names = [v.strip() for v in names.split(',') if v.strip() != '']
+            unknown = [name for name in names if name not in METRIC_REGISTRY]
+            if unknown:
+                show_msg('Warning', 'Warning', f'Unknown metrics: {", ".join(unknown)}')
+                return
+            self.hvdb.metric_names = names
+            self.hvdb.save_config()
+            self.center_canvas.canvas.show_image()
+
     # ---------------------------------------
     # slots: auto zoom
     # ---------------------------------------
@@ -496,13 +717,84 @@ class MainWindow(QMainWindow):
         img_path = self.center_canvas.canvas.img_path
         tmp_video_path = str(os.path.dirname(img_path)) + ".mp4"
         video_path = self.hvdb.compare_config.get("video_path", tmp_video_path)
-        target_path, ok = QInputDialog.getText(self, 'Export Video',
-        'Input the video saving path                          ',
-        QLineEdit.Normal, str(video_path))  # fill in space in label to increase width
-        if ok:
+        options = dict(video_export.DEFAULT_EXPORT_OPTIONS)
+        options.update(self.hvdb.compare_config.get("export_options", {}))
+        num_frames = min(len(paths) for paths in self.hvdb.path_list)
+        export_setting_box = ExportVideoSetting(
+            video_path,
+            options,
+            video_export.LAYOUTS,
+            video_export.CODECS,
+            video_export.SIZE_POLICIES,
+            video_export.ALPHA_POLICIES,
+            start_frame=self.resume_frames.get(video_path, 0),
+            num_frames=num_frames)
+        if export_setting_box.exec_():
+            target_path, options = export_setting_box.exportConfig()
             self.hvdb.compare_config["video_path"] = target_path
+            self.hvdb.compare_config["export_options"] = options
             self.hvdb.save_config()
-            utils.export_video(self.hvdb.path_list, target_path)
+            # snapshot the lists, so that a later refresh or filter change does not alter a queued export
+            job = video_export.ExportJob(
+                [list(paths) for paths in self.hvdb.path_list],
+                target_path,
+                options,
+                list(self.hvdb.folder_list),
+                start_frame=export_setting_box.startFrame())
+            self.add_export_job(job)
+
+    def add_export_job(self, job):
+        """Queue an export. Exports run one by one in the background, with a progress dialog."""
+        export_worker = get_export_worker()
+        if self.export_progress is None:
+            self.export_progress = QProgressDialog('', 'Cancel', 0, 100, self)
+            self.export_progress.setWindowTitle('Export Video')
+            self.export_progress.setModal(False)
+            self.export_progress.setAutoReset(False)
+            self.export_progress.setAutoClose(False)
+            self.export_progress.canceled.connect(self.cancel_export)
+            export_worker.progress.connect(self.show_export_progress)
+            export_worker.job_done.connect(self.on_export_done)
+        self.export_jobs.append(job)
+        export_worker.add_job(job)
+        self.set_statusbar(f'Export queued: {job.name}')
+
+    def show_export_progress(self, job, done, total, fps, eta):
+        if job not in self.export_jobs:  # queued by another window
+            return
+        self.running_export = job
+        num_queued = sum(j in self.export_jobs for j in get_export_worker().pending_jobs())
+        eta = f'{int(eta) // 60}:{int(eta) % 60:02d}' if eta >= 0 else '--:--'
+        text = f'Exporting {job.name}\n{done} / {total} frames, {fps:.1f} frames/s, ETA {eta}'
+        if num_queued > 0:
+            text += f'\n{num_queued} more exports queued'
+        self.export_progress.setMaximum(max(total, 1))
+        self.export_progress.setValue(done)
+        self.export_progress.setLabelText(text)
+        if not self.export_progress.isVisible():
+            self.export_progress.show()
+
+    def cancel_export(self):
+        if self.running_export is not None:
+            get_export_worker().cancel(self.running_export)
+
+    def on_export_done(self, job, error):
+        if job not in self.export_jobs:
+            return
+        self.export_jobs.remove(job)
+        self.running_export = None
+        self.export_progress.reset()
+        self.export_progress.hide()
+        if error:
+            self.resume_frames.pop(job.video_path, None)
+            show_msg('Critical', 'Export Video', f'Export failed: {job.name}\n{error}')
+        elif job.is_complete:
+            self.resume_frames.pop(job.video_path, None)
+            self.set_statusbar(f'Exported: {job.output_path}')
+        else:
+            # export it again from the start frame to resume
+            self.resume_frames[job.video_path] = job.next_frame
+            self.set_statusbar(f'Export cancelled at frame {job.next_frame}: {job.output_path}')
 
 
 def create_new_window(init_path=None):
@@ -519,7 +811,10 @@ def create_new_window(init_path=None):
 
 
 if __name__ == '__main__':
+    import multiprocessing
     import platform
+    # process pools in the frozen (PyInstaller) application
+    multiprocessing.freeze_support()
     if platform.system() == 'Windows':
         # set the icon in the task bar
         import ctypes
@@ -0,0 +1,79 @@
+"""
+LRU cache bounded by the total size of its values.
+
+It backs the in-memory caches of HandyView: decoded images (prefetch.py),
+tile pixmaps, giant images and their decoded sources (tiles.py), pyramid
+levels (pyramid.py) and metric references (metrics.py). Each cache only
+differs by its budget and by how the size of a value is measured.
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache():
+    """Thread-safe LRU cache, bounded by the total size of its values.
+
+    A value larger than the whole budget is not stored, so that one oversized
+    value never evicts everything else.
+
+    Args:
+        max_size (int): Budget for the total size, e.g., in bytes.
+        size (func): Size of a value. Default: None (1 for every value, i.e.,
+            max_size bounds the number of values).
+    """
+
+    def __init__(self, max_size, size=None):
+        self.max_size = max_size
+        self.size = (lambda value: 1) if size is None else size
+        self.total_size = 0
+        self._data = OrderedDict()  # key: (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value):
+        """Store a value as the most recently used one, evicting the least recently used ones.
+
+        Returns:
+            bool: Whether the value is stored.
+        """
+        size = self.size(value)
+        if size > self.max_size:
+            return False
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (value, size)
+            self.total_size += size
+            while self.total_size > self.max_size:
+                self._pop(next(iter(self._data)))
+        return True
+
+    def pop(self, key):
+        """Remove a value, and return it (None if missing)."""
+        with self._lock:
+            return self._pop(key)
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is None:
+            return None
+        self.total_size -= item[1]
+        return item[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.total_size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
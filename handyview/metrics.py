@@ -0,0 +1,231 @@
+"""
+Full-reference metrics between the compare folders and the base folder.
+
+Metrics are registered in METRIC_REGISTRY (see register_metric). Images stay
+in uint8, and the metrics that need float maps (e.g., SSIM) are computed on
+row tiles, so large frames never get full float copies. The reference image
+is decoded once and reused for all the compare views, and the compare views
+are evaluated in parallel (OpenCV releases the GIL).
+"""
+import cv2
+import math
+import numpy as np
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from handyview.lru import LRUCache
+
+NUM_WORKERS = 4
+# number of decoded reference images kept in memory
+NUM_REFERENCES = 2
+# rows of a tile for tiled metrics
+TILE_ROWS = 256
+
+METRIC_REGISTRY = OrderedDict()
+
+
+def register_metric(name):
+    """Register a metric function, which takes two uint8 BGR images of the same shape and returns a float."""
+
+    def _register(func):
+        METRIC_REGISTRY[name] = func
+        return func
+
+    return _register
+
+
+def read_image(path):
+    """Read an image as uint8 BGR array."""
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise IOError(f'Cannot read {path}')
+    return img
+
+
+def tiled_sum(img1, img2, func, halo=0, tile_rows=TILE_ROWS):
+    """Sum a per-pixel map over row tiles.
+
+    Args:
+        img1, img2 (ndarray): Images with the same shape.
+        func (func): Map function on (tile1, tile2), returning an array (or
+            a tuple of arrays) with the same height as the tiles.
+        halo (int): Extra rows on both sides of a tile, which must cover the
+            filter radius used by func. The halo rows are not summed.
+        tile_rows (int): Rows of a tile. Default: TILE_ROWS.
+
+    Returns:
+        float | tuple[float]: Sum of the map(s).
+    """
+    height = img1.shape[0]
+    totals = None
+    for y in range(0, height, tile_rows):
+        y0, y1 = max(y - halo, 0), min(y + tile_rows + halo, height)
+        tile_maps = func(img1[y0:y1], img2[y0:y1])
+        is_tuple = isinstance(tile_maps, tuple)
+        if not is_tuple:
+            tile_maps = (tile_maps, )
+        sums = [float(m[y - y0:min(y + tile_rows, height) - y0].sum(dtype=np.float64)) for m in tile_maps]
+        totals = sums if totals is None else [a + b for a, b in zip(totals, sums)]
+    return tuple(totals) if is_tuple else totals[0]
+
+
+def _psnr(sse, num, data_range=255.):
+    if sse == 0:
+        return float('inf')
+    return 10 * math.log10(data_range**2 * num / sse)
+
+
+def check_shape(img1, img2):
+    if img1.shape != img2.shape:
+        raise ValueError(f'Image shapes are different: {img1.shape}, {img2.shape}.')
+
+
+@register_metric('PSNR')
+def calculate_psnr(img1, img2):
+    """PSNR between two uint8 images.
+
+    The sum of squared errors is accumulated by cv2.norm, without float
+    copies of the images.
+    """
+    return _psnr(cv2.norm(img1, img2, cv2.NORM_L2SQR), img1.size)
+
+
+def _channel_psnr(channel):
+
+    def _calculate(img1, img2):
+        return _psnr(cv2.norm(img1[..., channel], img2[..., channel], cv2.NORM_L2SQR), img1.size // img1.shape[2])
+
+    return _calculate
+
+
+# per-channel PSNR (images are in BGR order)
+register_metric('PSNR-R')(_channel_psnr(2))
+register_metric('PSNR-G')(_channel_psnr(1))
+register_metric('PSNR-B')(_channel_psnr(0))
+
+
+def bgr2y(img):
+    """BGR (uint8) to the Y channel of YCbCr (ITU-R BT.601), in [16, 235]."""
+    img = img.astype(np.float32)
+    return img[..., 0] * (24.966 / 255.) + img[..., 1] * (128.553 / 255.) + img[..., 2] * (65.481 / 255.) + 16.
+
+
+@register_metric('PSNR-Y')
+def calculate_psnr_y(img1, img2):
+    sse = tiled_sum(img1, img2, lambda t1, t2: np.square(bgr2y(t1) - bgr2y(t2)))
+    return _psnr(sse, img1.shape[0] * img1.shape[1])
+
+
+@register_metric('MAE')
+def calculate_mae(img1, img2):
+    return cv2.norm(img1, img2, cv2.NORM_L1) / img1.size
+
+
+@register_metric('MSE')
+def calculate_mse(img1, img2):
+    return cv2.norm(img1, img2, cv2.NORM_L2SQR) / img1.size
+
+
+# SSIM with an 11x11 Gaussian window (sigma 1.5), the same as the original paper
+SSIM_WIN_SIZE = 11
+SSIM_SIGMA = 1.5
+SSIM_C1 = (0.01 * 255)**2
+SSIM_C2 = (0.03 * 255)**2
+
+
+def _ssim_maps(img1, img2):
+    """SSIM map and contrast-structure map of float32 images."""
+    blur = lambda x: cv2.GaussianBlur(x, (SSIM_WIN_SIZE, SSIM_WIN_SIZE), SSIM_SIGMA)  # noqa: E731
+    mu1, mu2 = blur(img1), blur(img2)
+    mu1_sq, mu2_sq, mu1_mu2 = mu1 * mu1, mu2 * mu2, mu1 * mu2
+    sigma1_sq = blur(img1 * img1) - mu1_sq
+    sigma2_sq = blur(img2 * img2) - mu2_sq
+    sigma12 = blur(img1 * img2) - mu1_mu2
+    cs_map = (2 * sigma12 + SSIM_C2) / (sigma1_sq + sigma2_sq + SSIM_C2)
+    ssim_map = ((2 * mu1_mu2 + SSIM_C1) / (mu1_sq + mu2_sq + SSIM_C1)) * cs_map
+    return ssim_map, cs_map
+
+
+def _tiled_ssim(img1, img2):
+    """Mean SSIM and mean contrast-structure over all pixels and channels."""
+    ssim, cs = tiled_sum(
+        img1, img2, lambda t1, t2: _ssim_maps(t1.astype(np.float32), t2.astype(np.float32)), halo=SSIM_WIN_SIZE // 2)
+    return ssim / img1.size, cs / img1.size
+
+
+@register_metric('SSIM')
+def calculate_ssim(img1, img2):
+    return _tiled_ssim(img1, img2)[0]
+
+
+MS_SSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+
+@register_metric('MS-SSIM')
+def calculate_ms_ssim(img1, img2):
+    """Multi-scale SSIM. The scales stop early for small images."""
+    values = []
+    for scale, weight in enumerate(MS_SSIM_WEIGHTS):
+        ssim, cs = _tiled_ssim(img1, img2)
+        last = scale == len(MS_SSIM_WEIGHTS) - 1 or min(img1.shape[:2]) < 2 * SSIM_WIN_SIZE
+        values.append((max(ssim if last else cs, 0.), weight))
+        if last:
+            break
+        # 2x2 average pooling; the smaller scales are cheap to keep in float32
+        img1 = cv2.resize(img1.astype(np.float32), (img1.shape[1] // 2, img1.shape[0] // 2),
+                          interpolation=cv2.INTER_AREA)
+        img2 = cv2.resize(img2.astype(np.float32), (img2.shape[1] // 2, img2.shape[0] // 2),
+                          interpolation=cv2.INTER_AREA)
+    weights = np.array([w for _, w in values])
+    weights /= weights.sum()
+    return float(np.prod([v**w for (v, _), w in zip(values, weights)]))
+
+
+def calculate_metrics(img1, img2, names):
+    """Calculate the metrics by names. Unknown names are ignored."""
+    check_shape(img1, img2)
+    return {name: METRIC_REGISTRY[name](img1, img2) for name in names if name in METRIC_REGISTRY}
+
+
+class MetricEngine():
+    """Compute metrics of several images against the same reference.
+
+    Args:
+        num_workers (int): Number of threads. Default: NUM_WORKERS.
+    """
+
+    def __init__(self, num_workers=NUM_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='hv_metric')
+        self._references = LRUCache(NUM_REFERENCES)  # (path, mtime): img
+
+    def get_reference(self, path):
+        key = (path, os.path.getmtime(path))
+        img = self._references.get(key)
+        if img is None:
+            img = read_image(path)
+            self._references.put(key, img)
+        return img
+
+    def _compute(self, ref_img, path, names):
+        try:
+            return calculate_metrics(ref_img, read_image(path), names)
+        except (IOError, ValueError) as error:
+            print(f'Metric error: {error}')
+            return {}
+
+    def compute(self, ref_path, paths, names=('PSNR', )):
+        """Compute the metrics of each image in paths against ref_path, in parallel.
+
+        Returns:
+            list[dict]: Metrics for each path, empty for the failed ones.
+        """
+        ref_img = self.get_reference(ref_path)
+        return list(self.executor.map(lambda path: self._compute(ref_img, path, names), paths))
+
+
+@lru_cache(maxsize=None)
+def get_metric_engine():
+    """Get the shared metric engine."""
+    return MetricEngine()
@@ -0,0 +1,98 @@
+"""
+Near-duplicate search over perceptual hashes (phash).
+
+The 64-bit phashes are packed into a uint64 array and indexed with
+multi-index hashing: each hash is split into NUM_CHUNKS 16-bit chunks, and
+each chunk has its own sorted table. By the pigeonhole principle, a hash
+within Hamming distance k of the query has at least one chunk within
+distance k // NUM_CHUNKS of the corresponding query chunk. Only those
+candidates are verified with a vectorized popcount.
+"""
+import numpy as np
+from itertools import combinations
+
+NUM_CHUNKS = 4
+CHUNK_BITS = 16
+# beyond this radius per chunk, probing is slower than a vectorized scan
+MAX_PROBE_RADIUS = 2
+
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hash_to_int(phash):
+    """Convert a 64-bit imagehash.ImageHash to int."""
+    return int(str(phash), 16)
+
+
+def popcount64(values):
+    """Count the set bits of each element in a uint64 array."""
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _neighbors(value, radius):
+    """All the 16-bit values within Hamming distance radius of value."""
+    values = [value]
+    for r in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), r):
+            mask = 0
+            for bit in bits:
+                mask |= 1 << bit
+            values.append(value ^ mask)
+    return np.array(values, dtype=np.uint64)
+
+
+class PHashIndex():
+    """Multi-index hashing over packed 64-bit phashes.
+
+    Args:
+        hashes (list[int]): 64-bit phash values.
+        keys (list): The key (e.g., (fidx, pidx)) of each hash.
+    """
+
+    def __init__(self, hashes, keys):
+        self.hashes = np.array(hashes, dtype=np.uint64)
+        self.keys = list(keys)
+        self.tables = []  # for each chunk: (sorted chunk values, argsort order)
+        mask = np.uint64((1 << CHUNK_BITS) - 1)
+        for c in range(NUM_CHUNKS):
+            values = (self.hashes >> np.uint64(c * CHUNK_BITS)) & mask
+            order = np.argsort(values, kind='stable')
+            self.tables.append((values[order], order))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def query(self, phash, max_dist):
+        """Find the hashes within Hamming distance max_dist of phash.
+
+        Args:
+            phash (int): Query hash.
+            max_dist (int): Maximum Hamming distance.
+
+        Returns:
+            list[tuple]: (distance, key), sorted by distance.
+        """
+        query = np.uint64(phash)
+        radius = max_dist // NUM_CHUNKS
+        if radius > MAX_PROBE_RADIUS:
+            candidates = np.arange(len(self.hashes))
+        else:
+            found = []
+            for c, (values, order) in enumerate(self.tables):
+                chunk = (phash >> (c * CHUNK_BITS)) & ((1 << CHUNK_BITS) - 1)
+                probes = _neighbors(chunk, radius)
+                starts = np.searchsorted(values, probes, side='left')
+                ends = np.searchsorted(values, probes, side='right')
+                for start, end in zip(starts, ends):
+                    if end > start:
+                        found.append(order[start:end])
+            if not found:
+                return []
+            candidates = np.unique(np.concatenate(found))
+        dists = popcount64(self.hashes[candidates] ^ query)
+        matched = dists <= max_dist
+        candidates, dists = candidates[matched], dists[matched]
+        order = np.argsort(dists, kind='stable')
+        return [(int(dists[i]), self.keys[candidates[i]]) for i in order]
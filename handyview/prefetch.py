@@ -0,0 +1,196 @@
+"""
+Background prefetch-and-decode cache for image browsing.
+
+Decoding a large image with QImage on the GUI thread stalls every key press.
+The Prefetcher decodes the images around the current index on worker threads
+and keeps them in a byte-budgeted LRU cache, so that the next (and the
+previous) navigation step only needs a dict lookup.
+
+Once shown, an image is kept as a QPixmap in QPixmapCache (see get_pixmap),
+and its QImage leaves the ImageCache, so that no image is cached twice.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PyQt5.QtGui import QImage, QImageReader, QPixmap, QPixmapCache
+
+from handyview.lru import LRUCache
+from handyview.tiles import is_giant
+
+# default memory budget for decoded images: 1 GB
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# memory budget for the pixmaps uploaded from the decoded images: 512 MB
+PIXMAP_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# number of navigation steps decoded ahead of the current one
+NUM_PREFETCH = 2
+NUM_WORKERS = 2
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class ImageCache(LRUCache):
+    """Thread-safe LRU cache for decoded QImages, bounded by bytes.
+
+    Entries are keyed by path and remember the file mtime at decode time. A
+    modified file is treated as a cache miss.
+
+    Args:
+        max_bytes (int): Memory budget for all cached images. Default: CACHE_MAX_BYTES.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        super(ImageCache, self).__init__(max_bytes, size=lambda item: item[1].sizeInBytes())
+
+    def get(self, path, mtime=None):
+        if mtime is None:
+            mtime = get_mtime(path)
+        item = super(ImageCache, self).get(path)
+        if item is None:
+            return None
+        if item[0] != mtime:
+            self.pop(path)
+            return None
+        return item[1]
+
+    def put(self, path, qimg, mtime=None):
+        if qimg is None or qimg.isNull():
+            return False
+        if mtime is None:
+            mtime = get_mtime(path)
+        return super(ImageCache, self).put(path, (mtime, qimg))
+
+
+class Prefetcher():
+    """Decode images on worker threads into an ImageCache.
+
+    Args:
+        cache (ImageCache): The cache to fill. Default: None (create a new one).
+        num_workers (int): Number of decoding threads. Default: NUM_WORKERS.
+    """
+
+    def __init__(self, cache=None, num_workers=NUM_WORKERS):
+        self.cache = ImageCache() if cache is None else cache
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='hv_prefetch')
+        self._pending = {}  # path: future
+        self._lock = threading.Lock()
+
+    def _decode(self, path, mtime=None, skip_giant=False):
+        if mtime is None:
+            mtime = get_mtime(path)
+        qimg = self.cache.get(path, mtime)
+        if qimg is None:
+            size = QImageReader(path).size() if skip_giant else None
+            if size is not None and is_giant(size.width(), size.height()):
+                # giant images are rendered with tiles (see tiles.py), never decoded entirely ahead of time
+                qimg = None
+            else:
+                qimg = QImage(path)
+                self.cache.put(path, qimg, mtime)
+        with self._lock:
+            self._pending.pop(path, None)
+        return qimg
+
+    def load(self, path, mtime=None):
+        """Return the decoded QImage of path.
+
+        Use the cached image, or wait for an in-flight prefetch of the same
+        path, and only decode synchronously as the last resort.
+
+        Args:
+            path (str): Image path.
+            mtime (float): Known file mtime, to save a stat call. Default: None.
+        """
+        qimg = self.cache.get(path, mtime)
+        if qimg is not None:
+            return qimg
+        with self._lock:
+            future = self._pending.get(path)
+        if future is not None and not future.cancel():
+            qimg = future.result()
+            if qimg is not None:  # None for skipped giant images
+                return qimg
+        return self._decode(path, mtime)
+
+    def prefetch(self, paths):
+        """Schedule paths for background decoding, in priority order.
+
+        Queued jobs that are no longer wanted (e.g., the browsing direction
+        changed) are cancelled. Images with a cached pixmap are skipped, so it
+        must be called on the GUI thread.
+        """
+        paths = [
+            path for path in dict.fromkeys(paths)
+            if path not in self.cache and not has_pixmap((path, get_mtime(path)))
+        ]
+        with self._lock:
+            for path, future in list(self._pending.items()):
+                if path not in paths and future.cancel():
+                    del self._pending[path]
+            for path in paths:
+                if path not in self._pending:
+                    self._pending[path] = self.executor.submit(self._decode, path, skip_giant=True)
+
+    def clear(self):
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        self.cache.clear()
+
+
+def _find_pixmap(key):
+    qpixmap = QPixmapCache.find(f'hv:{key[0]}:{key[1]}')
+    return None if qpixmap is None or qpixmap.isNull() else qpixmap
+
+
+def has_pixmap(key):
+    """Whether the QPixmap of an image is cached. It must be called on the GUI thread."""
+    return _find_pixmap(key) is not None
+
+
+def get_pixmap(qimg, key):
+    """Get the QPixmap of a decoded image from QPixmapCache, converting it only on a miss.
+
+    Once the pixmap is cached, the QImage is evicted from the ImageCache of the
+    prefetcher, as find_image gets it back from the pixmap.
+    It must be called on the GUI thread.
+
+    Args:
+        qimg (QImage): Decoded image.
+        key (tuple): (path, mtime) of the image.
+    """
+    if QPixmapCache.cacheLimit() < PIXMAP_CACHE_MAX_BYTES // 1024:
+        QPixmapCache.setCacheLimit(PIXMAP_CACHE_MAX_BYTES // 1024)  # in KB
+    qpixmap = _find_pixmap(key)
+    if qpixmap is None:
+        qpixmap = QPixmap.fromImage(qimg)
+        if QPixmapCache.insert(f'hv:{key[0]}:{key[1]}', qpixmap):
+            get_prefetcher().cache.pop(key[0])
+    return qpixmap
+
+
+def find_image(key):
+    """Get the QImage of an image back from its cached QPixmap, without decoding it again.
+
+    It must be called on the GUI thread.
+
+    Args:
+        key (tuple): (path, mtime) of the image.
+
+    Returns:
+        QImage | None: None if the pixmap is not cached.
+    """
+    qpixmap = _find_pixmap(key)
+    return None if qpixmap is None else qpixmap.toImage()
+
+
+@lru_cache(maxsize=None)
+def get_prefetcher():
+    """Get the prefetcher shared by all canvases."""
+    return Prefetcher()
@@ -0,0 +1,159 @@
+"""
+Multi-resolution (mipmap) pyramids for zoomed-out viewing.
+
+Level k of a pyramid is the image downscaled by 2**k. When a view is zoomed
+out, Qt would scale the full-resolution pixmap at every paint. HVPixmapItem
+draws from the level nearest the current zoom (but not coarser), so a
+zoomed-out paint only touches a few more pixels than the viewport has.
+
+Pyramids are built on a worker thread when a zoomed-out paint first needs
+them, and kept in a byte-budgeted LRU cache.
+"""
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PyQt5 import sip
+from PyQt5.QtCore import QObject, QRectF, Qt, pyqtSignal
+from PyQt5.QtGui import QPixmap
+from PyQt5.QtWidgets import QGraphicsPixmapItem
+
+from handyview.lru import LRUCache
+
+# memory budget for pyramid levels: 256 MB
+PYRAMID_MAX_BYTES = 256 * 1024 * 1024
+# the longer side of the coarsest level
+MIN_LEVEL_SIZE = 256
+NUM_WORKERS = 1
+
+
+def get_num_levels(width, height, min_size=MIN_LEVEL_SIZE):
+    """Number of levels (excluding the full resolution) whose longer side is at least min_size."""
+    longer = max(width, height)
+    if longer < 2 * min_size:
+        return 0
+    return int(math.log2(longer / min_size))
+
+
+def get_level(scale, num_levels):
+    """The coarsest level whose resolution is still >= the display resolution at scale."""
+    if scale <= 0:
+        return 0
+    return max(0, min(int(math.floor(-math.log2(scale))), num_levels))
+
+
+def get_scale(painter):
+    """Scale of the painter transform, with rotation."""
+    transform = painter.worldTransform()
+    return math.hypot(transform.m11(), transform.m12())
+
+
+def build_levels(qimg, num_levels):
+    """Build the levels 1 - num_levels of a QImage. It runs on worker threads.
+
+    A level is half of the previous one, rounded up, so that it covers the whole image.
+    """
+    levels = []
+    for _ in range(num_levels):
+        qimg = qimg.scaled(-(-qimg.width() // 2), -(-qimg.height() // 2), Qt.IgnoreAspectRatio,
+                           Qt.SmoothTransformation)
+        levels.append(qimg)
+    return levels
+
+
+def levels_size(levels):
+    return sum(level.sizeInBytes() for level in levels)
+
+
+class PyramidBuilder(QObject):
+    """Build pyramids on a worker thread, and repaint the items waiting for them."""
+    built = pyqtSignal(object)  # key
+
+    def __init__(self, cache=None, num_workers=NUM_WORKERS):
+        super(PyramidBuilder, self).__init__()
+        self.cache = LRUCache(PYRAMID_MAX_BYTES, size=levels_size) if cache is None else cache
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='hv_pyramid')
+        self._pending = {}  # key: items to repaint
+        self._lock = threading.Lock()
+        # queued connection: the slot runs on the GUI thread
+        self.built.connect(self._repaint)
+
+    def request(self, key, get_qimg, num_levels, item=None):
+        """Build the pyramid of an image in the background, and repaint item when it is done.
+
+        Args:
+            key: Cache key of the image.
+            get_qimg (func): Returns the QImage to build the pyramid from. It is
+                called on the calling thread, and only if the pyramid is not already being built.
+            num_levels (int): Number of levels.
+            item (QGraphicsItem): Item to repaint. Default: None.
+        """
+        with self._lock:
+            if key in self._pending:
+                if item is not None:
+                    self._pending[key].append(item)
+                return
+            self._pending[key] = [] if item is None else [item]
+        self.executor.submit(self._build, key, get_qimg(), num_levels)
+
+    def _build(self, key, qimg, num_levels):
+        try:
+            self.cache.put(key, build_levels(qimg, num_levels))
+        except Exception as error:
+            print(f'Pyramid error for {key}: {error}')
+        self.built.emit(key)
+
+    def _repaint(self, key):
+        with self._lock:
+            items = self._pending.pop(key, [])
+        for item in items:
+            if not sip.isdeleted(item):
+                item.update()
+
+
+class HVPixmapItem(QGraphicsPixmapItem):
+    """A QGraphicsPixmapItem that draws from the pyramid level nearest the current zoom.
+
+    Args:
+        qpixmap (QPixmap): Full-resolution pixmap.
+        key: Cache key of the image, e.g., (path, mtime).
+    """
+
+    def __init__(self, qpixmap, key, parent=None):
+        super(HVPixmapItem, self).__init__(parent)
+        self.set_image(qpixmap, key)
+
+    def set_image(self, qpixmap, key):
+        """Show another image in place."""
+        self.setPixmap(qpixmap)
+        self.key = key
+        self.num_levels = get_num_levels(qpixmap.width(), qpixmap.height())
+        self.level_pixmaps = {}  # level: QPixmap, uploaded on demand
+
+    def get_level_pixmap(self, level):
+        qpixmap = self.level_pixmaps.get(level)
+        if qpixmap is not None:
+            return qpixmap
+        builder = get_pyramid_builder()
+        levels = builder.cache.get(self.key)
+        if levels is None:
+            # built from the pixmap on demand, instead of keeping the decoded image next to it
+            builder.request(self.key, self.pixmap().toImage, self.num_levels, self)
+            return None
+        qpixmap = QPixmap.fromImage(levels[level - 1])
+        self.level_pixmaps[level] = qpixmap
+        return qpixmap
+
+    def paint(self, painter, option, widget=None):
+        level = get_level(get_scale(painter), self.num_levels)
+        qpixmap = self.get_level_pixmap(level) if level > 0 else None
+        if qpixmap is None:  # full resolution, or the pyramid is not built yet
+            super(HVPixmapItem, self).paint(painter, option, widget)
+            return
+        painter.drawPixmap(self.boundingRect(), qpixmap, QRectF(qpixmap.rect()))
+
+
+@lru_cache(maxsize=None)
+def get_pyramid_builder():
+    """Get the pyramid builder shared by all canvases."""
+    return PyramidBuilder()
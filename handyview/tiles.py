@@ -0,0 +1,367 @@
+"""
+Tiled rendering for giant images (e.g., stitched panoramas).
+
+A giant image is never converted to one full QPixmap. HVTiledItem only
+paints the tiles intersecting the exposed (viewport) rect, and the missing
+tiles are decoded on worker threads:
+    formats with clip-rect decoding (e.g., JPEG) decode only the tile region;
+    other formats are decoded into a source QImage (without a QPixmap copy),
+    and the tiles are cut from it. The source is the full image (and its
+    levels) if it fits in the source budget, or else a band of tile rows
+    (see bands.py), whose coarser levels are reduced from the bands below.
+Tiles are uploaded to QPixmaps on the GUI thread. Tiles and sources are kept in
+byte-budgeted LRU caches (see get_tile_cache and get_source_cache), so memory
+stays bounded whatever the image size.
+
+When zoomed out, tiles are taken from a coarser pyramid level (see
+pyramid.py): a level-k tile covers 2**k x 2**k tiles of the full image and
+is decoded with scaled decoding where the format supports it.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from PyQt5 import sip
+from PyQt5.QtCore import QObject, QRect, QRectF, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QImage, QImageIOHandler, QImageReader, QPixmap
+from PyQt5.QtWidgets import QGraphicsItem, QStyleOptionGraphicsItem
+from PIL import Image
+
+from handyview.bands import BandReader
+from handyview.lru import LRUCache
+from handyview.pyramid import build_levels, get_level, get_num_levels, get_scale
+
+TILE_SIZE = 1024
+# images with more pixels are rendered with tiles
+TILED_MIN_PIXELS = 8192 * 8192
+# memory budget for tile pixmaps: 256 MB
+TILE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# memory budget for the decoded sources of formats without clip-rect decoding: 1 GB
+TILE_SOURCES_MAX_BYTES = 1024 * 1024 * 1024
+# number of giant images whose TiledImage is kept
+NUM_SOURCES = 2
+NUM_WORKERS = 2
+
+
+def is_giant(width, height):
+    return width * height >= TILED_MIN_PIXELS
+
+
+def pixmap_size(qpixmap):
+    return qpixmap.width() * qpixmap.height() * qpixmap.depth() // 8
+
+
+def source_size(source):
+    if isinstance(source, QImage):
+        return source.sizeInBytes()
+    return source.width * source.height * len(source.getbands())  # PIL band
+
+
+def pil_to_qimage(img):
+    """Convert a PIL image to a QImage owning its data."""
+    img = img.convert('RGBA')
+    return QImage(img.tobytes(), img.width, img.height, img.width * 4, QImage.Format_RGBA8888).copy()
+
+
+class TiledImage():
+    """Tile source of a giant image.
+
+    Tiles are indexed by (level, tx, ty). Tile rects are in the coordinates
+    of their level, and source rects are in the full image coordinates.
+
+    It has the width, height and pixel methods of QImage used by the canvas
+    (e.g., the mouse color), so it can stand in for the decoded QImage.
+
+    Args:
+        path (str): Image path.
+        width (int): Image width.
+        height (int): Image height.
+        mtime (float): File mtime, part of the tile keys. Default: None.
+    """
+
+    def __init__(self, path, width, height, mtime=None):
+        self.path = path
+        self._width = width
+        self._height = height
+        self.key = (path, mtime)
+        self.num_levels = get_num_levels(width, height)
+        reader = QImageReader(path)
+        self.clip_decoding = reader.supportsOption(QImageIOHandler.ClipRect)
+        self.scaled_decoding = reader.supportsOption(QImageIOHandler.ScaledSize)
+        # for formats without clip-rect decoding, the decoded sources are kept in get_source_cache
+        self.band_decoding = width * height * 4 > TILE_SOURCES_MAX_BYTES
+        self.bands = None  # BandReader, created on the first band
+        self.item = None  # the HVTiledItem showing this image
+        self._lock = threading.Lock()
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+    def rect(self):
+        return QRect(0, 0, self._width, self._height)
+
+    def level_rect(self, level):
+        scale = 2**level
+        return QRect(0, 0, -(-self._width // scale), -(-self._height // scale))
+
+    def tile_rect(self, tile):
+        level, tx, ty = tile
+        return QRect(tx * TILE_SIZE, ty * TILE_SIZE, TILE_SIZE, TILE_SIZE).intersected(self.level_rect(level))
+
+    def source_rect(self, tile):
+        """The rect of a tile in the full image."""
+        scale = 2**tile[0]
+        rect = self.tile_rect(tile)
+        return QRect(rect.x() * scale, rect.y() * scale, rect.width() * scale,
+                     rect.height() * scale).intersected(self.rect())
+
+    def tiles_in(self, rect, level=0):
+        """Tiles of a level intersecting rect (in the full image), from the top left."""
+        rect = rect.intersected(self.rect())
+        if rect.isEmpty():
+            return []
+        size = TILE_SIZE * 2**level
+        return [(level, tx, ty)
+                for ty in range(rect.top() // size, rect.bottom() // size + 1)
+                for tx in range(rect.left() // size, rect.right() // size + 1)]
+
+    def tile_key(self, tile):
+        return self.key + tile
+
+    def decode_tile(self, tile):
+        """Decode a tile to QImage. It runs on worker threads."""
+        level = tile[0]
+        rect = self.tile_rect(tile)
+        if self.clip_decoding:
+            reader = QImageReader(self.path)
+            reader.setClipRect(self.source_rect(tile))
+            if level > 0 and self.scaled_decoding:
+                reader.setScaledSize(rect.size())
+            qimg = reader.read()
+            if qimg.size() != rect.size():
+                qimg = qimg.scaled(rect.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            return qimg
+        if self.band_decoding:
+            top = tile[2] * TILE_SIZE
+            band = self.get_band(level, tile[2])
+            return pil_to_qimage(band.crop((rect.x(), rect.y() - top, rect.right() + 1, rect.bottom() + 1 - top)))
+        return self.get_source(level).copy(rect)
+
+    def get_source(self, level):
+        """Get a decoded level (QImage), for images fitting in the source budget. It runs on worker threads."""
+        key = self.key + (level, )
+        cache = get_source_cache()
+        source = cache.get(key)
+        if source is not None:
+            return source
+        with self._lock:  # the other workers wait for this source instead of decoding it again
+            source = cache.get(key)
+            if source is None:
+                full = cache.get(self.key + (0, ))
+                if full is None:
+                    full = QImage(self.path)
+                    cache.put(self.key + (0, ), full)
+                source = full
+                if level > 0:
+                    levels = build_levels(full, self.num_levels)
+                    for idx, qimg in enumerate(levels, 1):
+                        cache.put(self.key + (idx, ), qimg)
+                    source = levels[level - 1]
+        return source
+
+    def get_band(self, level, ty):
+        """Get the band of a tile row (PIL image), for images too big for the source budget. It runs on worker threads.
+
+        Level 0 bands are decoded by BandReader, and the band of a coarser level is reduced from the two bands below it.
+        """
+        band = get_source_cache().get(self.key + (level, ty))
+        if band is not None:
+            return band
+        with self._lock:  # the other workers wait for this band instead of decoding it again
+            return self._get_band(level, ty)
+
+    def _get_band(self, level, ty):
+        cache = get_source_cache()
+        key = self.key + (level, ty)
+        band = cache.get(key)
+        if band is not None:
+            return band
+        if level == 0:
+            if self.bands is None:
+                # the bands decoded on the way (e.g., above the requested one) are kept too
+                self.bands = BandReader(
+                    self.path, TILE_SIZE, keep=lambda idx, band: cache.put(self.key + (0, idx), band))
+            return self.bands.read(ty)
+        num_bands = -(-self.level_rect(level - 1).height() // TILE_SIZE)
+        parts = [self._get_band(level - 1, idx).reduce(2) for idx in (2 * ty, 2 * ty + 1) if idx < num_bands]
+        band = Image.new(parts[0].mode, (self.level_rect(level).width(), sum(part.height for part in parts)))
+        for idx, part in enumerate(parts):
+            band.paste(part, (0, idx * parts[0].height))
+        cache.put(key, band)
+        return band
+
+    def pixel(self, x, y):
+        full = None if self.band_decoding else get_source_cache().get(self.key + (0, ))
+        if full is not None:
+            return full.pixel(x, y)
+        tile = (0, x // TILE_SIZE, y // TILE_SIZE)
+        qpixmap = get_tile_cache().get(self.tile_key(tile))
+        if qpixmap is None:  # not decoded yet
+            return 0
+        rect = self.tile_rect(tile)
+        return qpixmap.copy(x - rect.x(), y - rect.y(), 1, 1).toImage().pixel(0, 0)
+
+
+class TileLoader(QObject):
+    """Decode tiles on worker threads. Decoded tiles are uploaded to the tile cache on the GUI thread."""
+    tile_decoded = pyqtSignal(object, object, object)  # TiledImage, tile, QImage
+
+    def __init__(self, num_workers=NUM_WORKERS):
+        super(TileLoader, self).__init__()
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='hv_tile')
+        self._pending = {}  # tile key: (TiledImage, future)
+        self._lock = threading.Lock()
+        # queued connection: the slot runs on the GUI thread
+        self.tile_decoded.connect(self._upload)
+
+    def request(self, image, tile):
+        key = image.tile_key(tile)
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = (image, self.executor.submit(self._decode, image, tile))
+
+    def cancel_levels(self, image, level):
+        """Cancel the queued tiles of image at other levels, e.g., after zooming."""
+        with self._lock:
+            for key, (other, future) in list(self._pending.items()):
+                if other is image and key[len(image.key)] != level and future.cancel():
+                    del self._pending[key]
+
+    def cancel_others(self, images):
+        """Cancel the queued tiles of images that are no longer shown."""
+        keys = {image.key for image in images}
+        with self._lock:
+            for key, (image, future) in list(self._pending.items()):
+                if image.key not in keys and future.cancel():
+                    del self._pending[key]
+
+    def _decode(self, image, tile):
+        try:
+            qimg = image.decode_tile(tile)
+        except Exception as error:
+            print(f'Tile error for {image.path}: {error}')
+            qimg = None
+        self.tile_decoded.emit(image, tile, qimg)
+
+    def _upload(self, image, tile, qimg):
+        with self._lock:
+            self._pending.pop(image.tile_key(tile), None)
+        if qimg is None or qimg.isNull():
+            return
+        get_tile_cache().put(image.tile_key(tile), QPixmap.fromImage(qimg))
+        item = image.item
+        if item is not None and not sip.isdeleted(item):
+            item.update(QRectF(image.source_rect(tile)))
+
+
+class HVTiledItem(QGraphicsItem):
+    """A QGraphicsItem painting a TiledImage tile by tile.
+
+    Args:
+        image (TiledImage): The giant image.
+    """
+
+    def __init__(self, image, parent=None):
+        super(HVTiledItem, self).__init__(parent)
+        # paint gets the exposed rect, i.e., the visible part of the item
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption, True)
+        self.placeholder = QColor(128, 128, 128, 64)
+        self.image = None
+        self.set_image(image)
+
+    def set_image(self, image):
+        """Show another giant image in place."""
+        self.prepareGeometryChange()
+        if self.image is not None and self.image.item is self:
+            self.image.item = None
+        self.image = image
+        image.item = self
+        self.level = 0  # the pyramid level of the last paint
+        self.update()
+
+    def boundingRect(self):
+        return QRectF(self.image.rect())
+
+    def paint(self, painter, option, widget=None):
+        if isinstance(option, QStyleOptionGraphicsItem) and not option.exposedRect.isEmpty():
+            exposed = option.exposedRect.toAlignedRect()
+        else:
+            exposed = self.image.rect()
+        level = get_level(get_scale(painter), self.image.num_levels)
+        loader = get_tile_loader()
+        if level != self.level:
+            loader.cancel_levels(self.image, level)
+            self.level = level
+        for tile in self.image.tiles_in(exposed, level):
+            if self.draw_tile(painter, tile):
+                continue
+            loader.request(self.image, tile)
+            # draw the coarser tile until this one is decoded
+            level, tx, ty = tile
+            if level >= self.image.num_levels or not self.draw_tile(painter, (level + 1, tx // 2, ty // 2),
+                                                                    self.image.source_rect(tile)):
+                painter.fillRect(self.image.source_rect(tile), self.placeholder)
+
+    def draw_tile(self, painter, tile, target=None):
+        """Draw a cached tile (only the part in target, default: the whole tile). Return False if not cached."""
+        qpixmap = get_tile_cache().get(self.image.tile_key(tile))
+        if qpixmap is None:
+            return False
+        source = self.image.source_rect(tile)
+        if target is None:
+            target = source
+        scale = 2**tile[0]
+        # the part of the pixmap in target
+        part = QRectF((target.x() - source.x()) / scale, (target.y() - source.y()) / scale,
+                      target.width() / scale, target.height() / scale)
+        painter.drawPixmap(QRectF(target), qpixmap, part)
+        return True
+
+
+@lru_cache(maxsize=None)
+def get_tile_cache():
+    """Get the cache of tile pixmaps shared by all canvases."""
+    return LRUCache(TILE_CACHE_MAX_BYTES, size=pixmap_size)
+
+
+@lru_cache(maxsize=None)
+def get_source_cache():
+    """Get the cache of decoded sources (levels or bands of giant images) shared by all canvases."""
+    return LRUCache(TILE_SOURCES_MAX_BYTES, size=source_size)
+
+
+@lru_cache(maxsize=None)
+def get_tile_loader():
+    """Get the tile loader shared by all canvases."""
+    return TileLoader()
+
+
+# TiledImages of the last shown giant images
+_sources = LRUCache(NUM_SOURCES)
+_sources_lock = threading.Lock()
+
+
+def get_tiled_image(path, width, height, mtime=None):
+    """Get the TiledImage of path. The last NUM_SOURCES ones are reused.
+
+    It is thread-safe, as the views of a compare canvas are loaded on worker threads.
+    """
+    key = (path, mtime)
+    with _sources_lock:
+        image = _sources.get(key)
+        if image is None:
+            image = TiledImage(path, width, height, mtime)
+            _sources.put(key, image)
+    return image
@@ -1,11 +1,15 @@
+import fnmatch
+import hashlib
 import os
 import re
 import sys
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
 from PIL import Image, ImageDraw
-import imageio.v2 as imageio
 import numpy as np
 import cv2
-from skimage.metrics import peak_signal_noise_ratio
+import imagehash
 
 FORMATS = ('.jpg', '.JPG', '.jpeg', '.JPEG', '.png', '.PNG', '.ppm', '.PPM', '.bmp', '.BMP', '.gif', '.GIF', '.tiff',
            '.TIFF', '.webp', '.WEBP')
@@ -18,6 +22,12 @@ if getattr(sys, 'frozen', False):
 else:
     ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# number of threads listing directories in scan_tree (listing is I/O bound, e.g., on NFS)
+SCAN_WORKERS = 8
+# number of base names whose natural sort keys are cached
+NATURAL_KEY_CACHE_SIZE = 1 << 20
+_NUMBER = re.compile(r'0*(\d+)')
+
 
 def sizeof_fmt(size, suffix='B'):
     """Get human readable file size.
@@ -76,169 +86,468 @@ def scandir(dir_path, suffix=None, recursive=False, full_path=False):
     return _scandir(dir_path, suffix=suffix, recursive=recursive)
 
 
-def get_img_list(folder, include_names=None, exclude_names=None, exact_exclude_names=None):
-    """Get the image list in a folder.
-    It also considers 'include' and 'exclude' strings.
+def scan_tree(root, suffix=FORMATS, num_workers=SCAN_WORKERS):
+    """Recursively scan a directory, listing the sub-directories in parallel.
+
+    Every listed directory adds its sub-directories to the shared queue of a
+    thread pool, so idle threads pick up the pending directories wherever
+    they are in the tree. Files are yielded as soon as their directory is
+    listed, so the first images are available long before the scan finishes.
+    Hidden files and directories are skipped.
+
+    Args:
+        root (str): Path of the directory.
+        suffix (str | tuple(str)): File suffix that we are interested in. Default: FORMATS.
+        num_workers (int): Number of listing threads. Default: SCAN_WORKERS.
+
+    Yields:
+        list[str]: The files (full paths) of one directory, in natural order.
+            The root directory comes first.
+    """
+
+    def list_dir(dir_path):
+        files, dirs = [], []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        dirs.append(entry.path)
+                    elif entry.name.endswith(suffix):
+                        files.append(entry.path.replace('\\', '/'))
+        except OSError as error:
+            print(f'Scan error for {dir_path}: {error}')
+        files.sort(key=path_key)
+        return files, dirs
+
+    executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='hv_scan')
+    pending = {executor.submit(list_dir, root)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                pending.update(executor.submit(list_dir, dir_path) for dir_path in dirs)
+                if files:
+                    yield files
+    finally:
+        # the consumer stopped early (e.g., another folder is opened)
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def tree_key(path):
+    """Natural sort key of a path in a scanned tree: by directory, then by base name."""
+    dir_path, _, name = path.rpartition('/')
+    return natural_key(dir_path), natural_key(name)
+
+
+@lru_cache(maxsize=NATURAL_KEY_CACHE_SIZE)
+def natural_key(name):
+    """Natural sort key of a base name, e.g., img2.png < img10.png. Ties are broken by the name itself.
+
+    The key is one string, so sorting compares plain strings: every number is
+    encoded as '\\0' + a length char + its digits (without leading zeros), and
+    '\\0' sorts before any character of a name. Keys are cached, so sorting,
+    refreshing and searching the same folder do not split the names again.
+    """
+    return _NUMBER.sub(_encode_number, name.lower()) + '\0\0' + name
+
+
+def _encode_number(match):
+    digits = match.group(1)
+    return f'\0{chr(0x21 + len(digits))}{digits}'
+
+
+def path_key(path):
+    """Natural sort key of an image path in a folder (only the base name matters)."""
+    return natural_key(path.rpartition('/')[2])
+
+
+class _SortedKeys():
+    """Sequence view of the keys of a sorted path list, for bisect."""
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return path_key(self.paths[idx])
+
+
+def find_path(paths, path):
+    """Find the index of path in a path list sorted by get_img_list, with binary search.
+
+    Raises:
+        ValueError: If path is not in paths.
+    """
+    idx = find_insert(paths, path)
+    if idx < len(paths) and paths[idx] == path:
+        return idx
+    raise ValueError(f'{path} is not in the path list')
+
+
+def find_insert(paths, path):
+    """Find where path goes in a path list sorted by get_img_list, with binary search."""
+    return bisect_left(_SortedKeys(paths), path_key(path))
+
+
+def scan_img_list(folder):
+    """List all the images in a folder (not recursive), in natural order, without any filter.
 
     Args:
         folder (str): Folder path.
-        include_names (list[str]): Included strings in image base names.
-        exclude_names: (list[str]): Excluded strings in image base names.
 
     Returns:
         list[str]: Image list.
     """
-    img_list = []
     if folder == '':
         folder = './'
-    if exact_exclude_names is not None:
-        for img_path in sorted(scandir(folder, suffix=None, recursive=False, full_path=True)):
-            img_path = img_path.replace('\\', '/')
-            base, ext = os.path.splitext(os.path.basename(img_path))
-            if ext in FORMATS:
-                basename = f'{base}{ext}'
-                if basename not in exact_exclude_names:
-                    img_list.append(img_path)
-    else:
-        # deal with include and exclude names
-        for img_path in sorted(scandir(folder, suffix=None, recursive=False, full_path=True)):
-            img_path = img_path.replace('\\', '/')
-            base, ext = os.path.splitext(os.path.basename(img_path))
-            if ext in FORMATS:
-                if include_names is not None:
-                    flag_add = False
-                    for include_name in include_names:
-                        if include_name in base:
-                            flag_add = True
-                elif exclude_names is not None:
-                    flag_add = True
-                    for exclude_name in exclude_names:
-                        if exclude_name in base:
-                            flag_add = False
-                else:
-                    flag_add = True
-                if flag_add:
-                    img_list.append(img_path)
-    # natural sort for numbers in names
-    img_list.sort(key=lambda s: [int(t) if t.isdigit() else t.lower() for t in re.split(r'(\d+)', s)])
+    img_list = [
+        img_path.replace('\\', '/') for img_path in scandir(folder, suffix=None, recursive=False, full_path=True)
+        if os.path.splitext(img_path)[1] in FORMATS
+    ]
+    # natural sort for numbers in names, in a single pass with the cached keys
+    img_list.sort(key=path_key)
     return img_list
 
 
-def crop_images(img_list,
-                rect_pos,
-                patch_folder,
-                enlarge_ratio=2,
-                interpolation='bicubic',
-                line_width=0,
-                color='yellow',
-                rect_folder=None):
-
-    color_tb = {}
-    # in BGR
-    # color_tb['yellow'] = (0, 255, 255)
-    # color_tb['green'] = (0, 255, 0)
-    # color_tb['red'] = (0, 0, 255)
-    # color_tb['magenta'] = (255, 0, 255)
-    # color_tb['matlab_blue'] = (189, 114, 0)
-    # color_tb['matlab_orange'] = (25, 83, 217)
-    # color_tb['matlab_yellow'] = (32, 177, 237)
-    # color_tb['matlab_purple'] = (142, 47, 126)
-    # color_tb['matlab_green'] = (48, 172, 119)
-    # color_tb['matlab_liblue'] = (238, 190, 77)
-    # color_tb['matlab_brown'] = (47, 20, 162)
-    # in RGB
-    color_tb['yellow'] = (255, 255, 0)
-    color_tb['green'] = (0, 255, 0)
-    color_tb['red'] = (255, 0, 0)
-    color_tb['magenta'] = (255, 0, 255)
-    color_tb['matlab_blue'] = (0, 114, 189)
-    color_tb['matlab_orange'] = (217, 83, 25)
-    color_tb['matlab_yellow'] = (237, 177, 32)
-    color_tb['matlab_purple'] = (126, 47, 142)
-    color_tb['matlab_green'] = (119, 172, 48)
-    color_tb['matlab_liblue'] = (77, 190, 238)
-    color_tb['matlab_brown'] = (162, 20, 47)
-    color = color_tb[color]
-
-    # make temp folder
-    os.makedirs(patch_folder, exist_ok=True)
-    if line_width > 0 and not os.path.exists(rect_folder):
-        os.makedirs(rect_folder)
-
-    start_h, start_w, len_h, len_w = rect_pos
-    for i, path in enumerate(img_list):
-        img = Image.open(path)
-        base_name = os.path.splitext(os.path.basename(path))[0]
+def compile_names(names):
+    """Compile filter rules into one regex, matched against image base names (without the extension).
+
+    Every rule is an alternative (OR). A rule may join several terms with '&'
+    (AND). A term is:
+        a regex, prefixed with 're:', e.g., 're:_x[24]$' (searched in the name);
+        a glob, with any of '*?[', e.g., 'img_*_sr' (matches the whole name);
+        otherwise a substring, e.g., 'sr'.
+
+    Args:
+        names (list[str]): Filter rules.
+
+    Returns:
+        re.Pattern: Use its match method on base names.
+
+    Raises:
+        re.error: For invalid regex terms.
+    """
+    alternatives = []
+    for name in names:
+        terms = []
+        for term in name.split('&'):
+            term = term.strip()
+            if term.startswith('re:'):
+                terms.append(f'(?=.*?(?:{term[3:]}))')
+            elif any(c in term for c in '*?['):
+                terms.append(f'(?={fnmatch.translate(term)})')
+            elif term:
+                terms.append(f'(?=.*?{re.escape(term)})')
+        if terms:
+            alternatives.append(''.join(terms))
+    # no valid rule matches nothing
+    return re.compile('|'.join(alternatives) if alternatives else '(?!)', re.DOTALL)
+
+
+class NameFilter():
+    """Filter image paths by their names. The rules are compiled once (see compile_names).
+
+    It follows the include and exclude options of HandyView: include names
+    take precedence over exclude names, and exact exclude names (whole file
+    names, with the extension) override both.
+
+    Args:
+        include_names (list[str]): Keep the images matching any rule. Default: None.
+        exclude_names (list[str]): Drop the images matching any rule. Default: None.
+        exact_exclude_names (list[str]): Drop the images with these file names. Default: None.
+    """
+
+    def __init__(self, include_names=None, exclude_names=None, exact_exclude_names=None):
+        self.include = None
+        self.exclude = None
+        self.exact_exclude_names = None
+        if exact_exclude_names is not None:
+            self.exact_exclude_names = set(exact_exclude_names)
+        elif include_names is not None:
+            self.include = compile_names(include_names)
+        elif exclude_names is not None:
+            self.exclude = compile_names(exclude_names)
+
+    def apply(self, img_list):
+        """Filter an image list, keeping its order. It does not touch the disk."""
+        if self.exact_exclude_names is not None:
+            return [path for path in img_list if path.rpartition('/')[2] not in self.exact_exclude_names]
+        if self.include is not None:
+            match = self.include.match
+            return [path for path in img_list if match(os.path.splitext(path.rpartition('/')[2])[0])]
+        if self.exclude is not None:
+            match = self.exclude.match
+            return [path for path in img_list if not match(os.path.splitext(path.rpartition('/')[2])[0])]
+        return list(img_list)
+
+
+def get_img_list(folder, include_names=None, exclude_names=None, exact_exclude_names=None):
+    """Get the image list in a folder, in natural order.
+    It also considers 'include' and 'exclude' rules (see NameFilter).
+
+    Args:
+        folder (str): Folder path.
+        include_names (list[str]): Included rules for image base names.
+        exclude_names: (list[str]): Excluded rules for image base names.
+        exact_exclude_names (list[str]): Excluded image file names.
+
+    Returns:
+        list[str]: Image list. Use find_path to search it.
+    """
+    return NameFilter(include_names, exclude_names, exact_exclude_names).apply(scan_img_list(folder))
+
+
+def get_compare_folders(config):
+    """Get view*_folder entries of a compare config, ordered by the view index."""
+    num_view = config.get('num_view', None)
+    folders = []
+    idx = 0
+    while f'view{idx}_folder' in config and (num_view is None or idx < num_view):
+        folders.append(config[f'view{idx}_folder'])
+        idx += 1
+    return folders
+
+
+# colors of the rectangles, in RGB
+CROP_COLORS = {
+    'yellow': (255, 255, 0),
+    'green': (0, 255, 0),
+    'red': (255, 0, 0),
+    'magenta': (255, 0, 255),
+    'matlab_blue': (0, 114, 189),
+    'matlab_orange': (217, 83, 25),
+    'matlab_yellow': (237, 177, 32),
+    'matlab_purple': (126, 47, 142),
+    'matlab_green': (119, 172, 48),
+    'matlab_liblue': (77, 190, 238),
+    'matlab_brown': (162, 20, 47)
+}
+CROP_INTERPOLATIONS = {'bicubic': Image.BICUBIC, 'bilinear': Image.BILINEAR, 'nearest': Image.NEAREST}
+# formats whose rows are decoded from top to bottom, so decoding can stop after the last row of the region
+ROW_SEQUENTIAL_FORMATS = ('PNG', 'PPM')
+
+
+def open_region(path, bottom=None):
+    """Open an image, decoding only the rows above bottom if the format allows.
+
+    Non-interlaced PNG and PPM files store the rows from top to bottom in a
+    single stream, so the rows below the region are never decoded. Other
+    formats are decoded entirely.
+
+    Args:
+        path (str): Image path.
+        bottom (int): The rows [0, bottom) are needed. Default: None (all).
+
+    Returns:
+        PIL.Image: The loaded image, whose height may be bottom.
+    """
+    img = Image.open(path)
+    width, height = img.size
+    if (bottom is not None and 0 < bottom < height and img.format in ROW_SEQUENTIAL_FORMATS and len(img.tile) == 1
+            and not img.info.get('interlace')):
+        codec, _, offset, args = img.tile[0]
+        img.tile = [(codec, (0, 0, width, bottom), offset, args)]
+        img._size = (width, bottom)
+    img.load()
+    return img
+
+
+def get_folder_names(folders):
+    """Short and unique names of folders (their base names), for output sub-folders.
+
+    Folders with the same base name are prefixed with their index, e.g., 0_results, 1_results.
+    """
+    names = [os.path.basename(os.path.normpath(folder)) or f'view{idx}' for idx, folder in enumerate(folders)]
+    return [f'{idx}_{name}' if names.count(name) > 1 else name for idx, name in enumerate(names)]
+
+
+def crop_image(path,
+               rects,
+               patch_folders,
+               enlarge_ratio=2,
+               interpolation='bicubic',
+               line_width=0,
+               color='yellow',
+               rect_folder=None):
+    """Crop rectangles from one image, which is decoded once (see crop_images). It runs in a process pool.
+
+    Args:
+        rects (list[list[int]]): [start_h, start_w, len_h, len_w] of each rectangle.
+        patch_folders (list[str]): Output folder of each rectangle.
+
+    Returns:
+        list[str]: Paths of the saved patches.
+    """
+    # the image with rectangles needs the whole image
+    bottom = None if line_width > 0 else max(start_h + len_h for start_h, _, len_h, _ in rects)
+    img = open_region(path, bottom)
+    base_name = os.path.splitext(os.path.basename(path))[0]
+    patch_paths = []
+    for (start_h, start_w, len_h, len_w), patch_folder in zip(rects, patch_folders):
         # crop patch
         patch = img.crop((start_w, start_h, start_w + len_w, start_h + len_h))
 
         # enlarge patch if necessary
         if enlarge_ratio > 1:
             w, h = patch.size
-            if interpolation == 'bicubic':
-                interpolation = Image.BICUBIC
-            elif interpolation == 'bilinear':
-                interpolation = Image.BILINEAR
-            elif interpolation == 'nearest':
-                interpolation = Image.NEAREST
-            patch = patch.resize((w * enlarge_ratio, h * enlarge_ratio), resample=interpolation)
-        patch.save(os.path.join(patch_folder, base_name + '_patch.png'))
-
-        # draw rectangle
-        if line_width > 0:
-            img_rect = img.convert('RGB')
-            draw = ImageDraw.Draw(img_rect)
-            draw.rectangle(((start_w, start_h), (start_w + len_w, start_h + len_h)), outline=color, width=line_width)
-            img_rect.save(os.path.join(rect_folder, base_name + '_rect.png'))
-
-
-# ---------------------------- Video Export ----------------------------------------
-
-def export_video(img_path_list, video_path):
-    img_list = merge_img(img_path_list)  # merge images into one image
-    img2vid_core(img_list, video_path)
-
-def merge_img(img_path_list):
-    ### img_path_list: [[img1, img2], [imgg1, imgg2]]
-    num_view = len(img_path_list)
-    num_frames = [len(x) for x in img_path_list]
-    print("the frames number in each folder is:", num_frames)
-
-    # https://paulzhn.me/posts/python-zip.html  zip will use the shortest folder
-    img_list = [cat_img(*x) for x in zip(*img_path_list)]
-    return img_list
+            patch = patch.resize((w * enlarge_ratio, h * enlarge_ratio), resample=CROP_INTERPOLATIONS[interpolation])
+        patch_path = os.path.join(patch_folder, base_name + '_patch.png')
+        patch.save(patch_path)
+        patch_paths.append(patch_path)
+
+    # draw rectangles
+    if line_width > 0:
+        img_rect = img.convert('RGB')
+        draw = ImageDraw.Draw(img_rect)
+        for start_h, start_w, len_h, len_w in rects:
+            draw.rectangle(((start_w, start_h), (start_w + len_w, start_h + len_h)),
+                           outline=CROP_COLORS[color],
+                           width=line_width)
+        img_rect.save(os.path.join(rect_folder, base_name + '_rect.png'))
+    img.close()
+    return patch_paths
+
+
+def crop_images(path_lists,
+                rects,
+                patch_folder,
+                enlarge_ratio=2,
+                interpolation='bicubic',
+                line_width=0,
+                color='yellow',
+                rect_folder=None,
+                folder_names=None,
+                num_workers=None,
+                progress=None,
+                is_cancelled=None):
+    """Crop the same rectangles from the images of several folders, in a process pool.
+
+    Each image is decoded once for all the rectangles. Outputs are saved in a tree:
+        patch_folder/rect{k}/{folder name}/{image name}_patch.png
+        rect_folder/{folder name}/{image name}_rect.png
+
+    Args:
+        path_lists (list[list[str]]): Image paths of each folder.
+        rects (list[list[int]]): [start_h, start_w, len_h, len_w] of each rectangle.
+        patch_folder (str): Root folder of the cropped patches.
+        enlarge_ratio (int): Patches are enlarged by this ratio. Default: 2.
+        interpolation (str): bicubic | bilinear | nearest. Default: bicubic.
+        line_width (int): If > 0, also save the images with the rectangles
+            drawn to rect_folder. Default: 0.
+        color (str): Rectangle color, a key of CROP_COLORS. Default: yellow.
+        rect_folder (str): Root folder of the images with rectangles. Default: None.
+        folder_names (list[str]): Sub-folder name of each folder. Default:
+            None (the base names of the image folders).
+        num_workers (int): Number of processes. Default: None (number of CPUs).
+        progress (func): Called with (done, total) in the order of the
+            images. Default: None.
+        is_cancelled (func): Return True to stop early. Default: None.
+
+    Returns:
+        int: Number of cropped images.
+    """
+    if color not in CROP_COLORS:
+        raise ValueError(f'Unknown color {color}.')
+    if interpolation not in CROP_INTERPOLATIONS:
+        raise ValueError(f'Unknown interpolation {interpolation}.')
+    if not rects:
+        raise ValueError('No rectangle to crop.')
+    if folder_names is None:
+        folder_names = get_folder_names([os.path.dirname(paths[0]) if paths else '' for paths in path_lists])
+
+    # make the output tree
+    jobs = []
+    for paths, folder_name in zip(path_lists, folder_names):
+        patch_folders = [os.path.join(patch_folder, f'rect{k}', folder_name) for k in range(len(rects))]
+        for folder in patch_folders:
+            os.makedirs(folder, exist_ok=True)
+        folder_rect = os.path.join(rect_folder, folder_name) if line_width > 0 else None
+        if folder_rect is not None:
+            os.makedirs(folder_rect, exist_ok=True)
+        jobs.extend((path, patch_folders, folder_rect) for path in paths)
+
+    total = len(jobs)
+    done = 0
+    func = partial(
+        _crop_jobs,
+        rects=rects,
+        enlarge_ratio=enlarge_ratio,
+        interpolation=interpolation,
+        line_width=line_width,
+        color=color)
+    # small chunks keep the progress smooth, larger ones reduce the IPC overhead for many small images
+    chunksize = max(1, min(16, total // (4 * (num_workers or os.cpu_count() or 1))))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(func, jobs[i:i + chunksize]) for i in range(0, total, chunksize)]
+        # waiting in submission order keeps the order of the jobs
+        for future in futures:
+            done += future.result()
+            if progress is not None:
+                progress(done, total)
+            if is_cancelled is not None and is_cancelled():
+                for f in futures:
+                    f.cancel()
+                break
+    return done
+
+
+def _crop_jobs(jobs, **kwargs):
+    for path, patch_folders, rect_folder in jobs:
+        crop_image(path, patch_folders=patch_folders, rect_folder=rect_folder, **kwargs)
+    return len(jobs)
+
+
+# ---------------------------- Fingerprint ----------------------------------------
+
+
+def md5sum(path, chunk_size=4 * 1024 * 1024, progress=None):
+    """Compute the md5 of a file in chunks, with bounded memory.
+
+    Args:
+        path (str): File path.
+        chunk_size (int): Bytes hashed at a time. Default: 4 MB.
+        progress (func): Called with (done_bytes, total_bytes) after each
+            chunk. Default: None.
 
-def cat_img(*img_paths, axis=1):
-    ### default cat images in row direction
-    imgs = [imageio.imread(x)[...,[2,1,0]] for x in img_paths]  # ignore alpha channel, BGR
-    return np.concatenate(imgs, axis=axis)
-
-def img2vid_core(images, output):
-    # Determine the width and height from the first image
-    frame = images[0]
-    height, width, channels = frame.shape
-
-    # Define the codec and create VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v') # Be sure to use lower case
-    out = cv2.VideoWriter(output, fourcc, 15.0, (width, height))
-
-    for idx, image in enumerate(images):
-        print("processing the %d image ... " % idx)
-        frame = image
-        out.write(frame)
-
-    # Release everything if job is finished
-    out.release()
-    print("The output video is {}".format(output))
-# ----------------------------------------------------------------------------------
-
-# ---------------------------- Metric Calculation ----------------------------------------
-
-def cal_psnr(orig_img_path, recon_img_path):
-    fn = lambda x: cv2.imread(x) / 255.
-    orig_img, recon_img = map(fn, [orig_img_path, recon_img_path])
-    psnr = peak_signal_noise_ratio(orig_img, recon_img)
-    return psnr
+    Returns:
+        str: md5 hex digest.
+    """
+    md5 = hashlib.md5()
+    total = os.path.getsize(path)
+    done = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            num = f.readinto(buffer)
+            if not num:
+                break
+            md5.update(view[:num])
+            done += num
+            if progress is not None:
+                progress(done, total)
+    return md5.hexdigest()
+
+
+def compute_fingerprint(path, progress=None):
+    """Compute (md5, phash hex string) of an image file.
+
+    It is a module-level function, so that it can run in a process pool.
+
+    Args:
+        progress (func): Called with (done_bytes, total_bytes) while hashing. Default: None.
+    """
+    md5 = md5sum(path, progress=progress)
+    with Image.open(path) as img:
+        phash = str(imagehash.phash(img))
+    return md5, phash
 
 
 # ---------------------------- For image magnification -----------------------------------
@@ -0,0 +1,501 @@
+"""
+Export the compare folders to a video.
+
+Frames go through a staged pipeline:
+    decode (thread pool, one job per view, with resizing and labels)
+    -> compose (arrange the views in the layout)
+    -> write (cv2.VideoWriter, in frame order)
+The stages are connected with bounded queues, so a slow writer stops the
+decoders (backpressure) and memory is bounded by a few frames, whatever
+the sequence length.
+
+The decode stage normalizes every view to a uint8 BGR frame (grayscale,
+alpha, 16-bit and float images), and the compose stage places the views
+into preallocated canvases, padding or resizing views whose size differs
+from the first frame. A frame that cannot be read becomes a black cell
+instead of aborting the export.
+
+An export can be cancelled (ExportPipeline.cancel) and resumed from a
+frame: since a video file cannot be appended, the remaining frames are
+written to a segment file next to it (see get_segment_path). ExportJob
+keeps what is needed to run, and to resume, an export in the background.
+
+It can also be used from the command line:
+    python -m handyview.video_export --config history.json --output out.mp4 --layout auto --fps 15 --scale 0.5
+"""
+import argparse
+import cv2
+import imageio.v2 as imageio
+import json
+import numpy as np
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from handyview.utils import ROOT_DIR, get_compare_folders, get_img_list
+
+# frames buffered between two stages
+QUEUE_SIZE = 4
+
+LAYOUTS = ('auto', 'row', 'column')
+CODECS = ('mp4v', 'avc1', 'XVID', 'MJPG')
+DEFAULT_EXPORT_OPTIONS = {
+    'layout': 'auto',  # auto: the same as the compare canvas (4 views in 2 x 2)
+    'fps': 15.0,
+    'codec': 'mp4v',
+    'quality': 0,  # 0 for the codec default; only some codecs (e.g., MJPG) support it
+    'scale': 1.0,  # downscale factor of each view
+    'labels': False,  # bool, or a list of labels for the views
+    'size_policy': 'pad',  # pad | resize: for views with a different size from the first frame
+    'alpha_policy': 'blend',  # blend (over black) | drop
+}
+SIZE_POLICIES = ('pad', 'resize')
+ALPHA_POLICIES = ('blend', 'drop')
+
+
+def get_grid(num_view, layout='auto'):
+    """Get (rows, columns) of the layout.
+
+    auto follows the compare canvas splitters: 2 and 3 views in a row, 4
+    views in 2 x 2.
+    """
+    if layout == 'row':
+        return 1, num_view
+    if layout == 'column':
+        return num_view, 1
+    if layout == 'auto':
+        if num_view == 4:
+            return 2, 2
+        return 1, num_view
+    raise ValueError(f'Unknown layout {layout}. Please choose one of: {", ".join(LAYOUTS)}.')
+
+
+def get_labels(folders, labels):
+    """Get the label of each view: the folder names if labels is True."""
+    if labels is True:
+        return [os.path.basename(os.path.normpath(folder)) for folder in folders]
+    if not labels:
+        return None
+    return list(labels)
+
+
+def draw_label(img, text):
+    """Draw a label at the top-left corner of a BGR frame, in place."""
+    scale = max(img.shape[0] / 720, 0.4)
+    thickness = max(int(2 * scale), 1)
+    (_, text_h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    org = (int(10 * scale), int(10 * scale) + text_h)
+    cv2.putText(img, text, org, cv2.FONT_HERSHEY_SIMPLEX, scale, (0, 0, 0), thickness + 2, cv2.LINE_AA)
+    cv2.putText(img, text, org, cv2.FONT_HERSHEY_SIMPLEX, scale, (255, 255, 255), thickness, cv2.LINE_AA)
+    return img
+
+
+def read_frame(path):
+    """Read a frame as it is stored (any dtype and channel number), in BGR(A) order."""
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if img is None:  # e.g., gif
+        img = imageio.imread(path)
+        if img.ndim == 3 and img.shape[2] >= 3:
+            img = img[..., [2, 1, 0] + list(range(3, img.shape[2]))]  # RGB(A) -> BGR(A)
+    if img is None:
+        raise IOError(f'Cannot read {path}')
+    return img
+
+
+def normalize_frame(img, alpha_policy='blend'):
+    """Normalize a frame to uint8 BGR with 3 channels.
+
+    Args:
+        img (ndarray): Gray (H, W) or (H, W, 1), gray + alpha, BGR or BGRA,
+            in uint8, uint16 or float ([0, 1]).
+        alpha_policy (str): blend: composite over black; drop: ignore alpha.
+
+    Returns:
+        ndarray: uint8 BGR image.
+    """
+    if img.dtype == np.uint16:
+        img = (img >> 8).astype(np.uint8)
+    elif img.dtype == np.bool_:
+        img = img.astype(np.uint8) * 255
+    elif np.issubdtype(img.dtype, np.floating):
+        img = (np.clip(img, 0, 1) * 255 + 0.5).astype(np.uint8)
+    elif img.dtype != np.uint8:
+        img = np.clip(img, 0, 255).astype(np.uint8)
+
+    if img.ndim == 2:
+        img = img[..., None]
+    num_channel = img.shape[2]
+    if num_channel in (2, 4):  # with alpha
+        color, alpha = img[..., :num_channel - 1], img[..., num_channel - 1:]
+        if alpha_policy == 'blend':
+            color = ((color.astype(np.uint16) * alpha + 127) // 255).astype(np.uint8)
+        img = color
+        num_channel -= 1
+    if num_channel == 1:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    elif num_channel > 3:
+        img = img[..., :3]
+    return img
+
+
+def load_view(path, scale=1.0, label=None, cell_size=None, size_policy='pad', alpha_policy='blend'):
+    """Decode a view, normalize it, then downscale it and draw its label.
+
+    Args:
+        cell_size (tuple): (height, width) of a view in the output. With
+            size_policy resize, other sizes are resized to it. Default: None.
+
+    Returns:
+        ndarray | None: uint8 BGR image, or None if the frame cannot be read.
+    """
+    try:
+        img = normalize_frame(read_frame(path), alpha_policy)
+    except Exception as error:
+        print(f'Skip the frame {path}: {error}')
+        return None
+    if scale != 1.0:
+        height, width = img.shape[:2]
+        size = (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    if size_policy == 'resize' and cell_size is not None and img.shape[:2] != tuple(cell_size):
+        img = cv2.resize(img, (cell_size[1], cell_size[0]), interpolation=cv2.INTER_AREA)
+    if label:
+        draw_label(img, label)
+    return img
+
+
+def compose(canvas, imgs, rows, cols):
+    """Place the views in a rows x cols grid of a preallocated canvas, in place.
+
+    Views larger than a cell are cropped, smaller ones are padded with black,
+    and missing views (None) are black.
+    """
+    cell_h, cell_w = canvas.shape[0] // rows, canvas.shape[1] // cols
+    for idx in range(rows * cols):
+        r, c = divmod(idx, cols)
+        cell = canvas[r * cell_h:(r + 1) * cell_h, c * cell_w:(c + 1) * cell_w]
+        img = imgs[idx] if idx < len(imgs) else None
+        if img is None:
+            cell[...] = 0
+            continue
+        h, w = min(img.shape[0], cell_h), min(img.shape[1], cell_w)
+        cell[:h, :w] = img[:h, :w]
+        if h < cell_h:
+            cell[h:] = 0
+        if w < cell_w:
+            cell[:h, w:] = 0
+    return canvas
+
+
+def get_segment_path(video_path, start_frame):
+    """Output path of an export starting from start_frame, e.g., out_from000120.mp4."""
+    if start_frame <= 0:
+        return video_path
+    stem, ext = os.path.splitext(video_path)
+    return f'{stem}_from{start_frame:06d}{ext}'
+
+
+class ExportPipeline():
+    """Decode, compose and write frames in parallel stages.
+
+    Args:
+        img_path_list (list[list[str]]): Image paths of each view. Frames are
+            aligned by index, and the shortest list is used.
+        video_path (str): Output video path.
+        options (dict): Export options, see DEFAULT_EXPORT_OPTIONS. Default: None.
+        labels (list[str]): Label of each view. Default: None.
+        num_workers (int): Number of decoding threads. Default: None (number of CPUs).
+        progress (func): Called with (done, total, fps) after each written frame.
+            done counts the skipped frames before start_frame. Default: None.
+        start_frame (int): Index of the first frame to export. Default: 0.
+    """
+
+    def __init__(self,
+                 img_path_list,
+                 video_path,
+                 options=None,
+                 labels=None,
+                 num_workers=None,
+                 progress=None,
+                 start_frame=0):
+        frames = list(zip(*img_path_list))
+        self.total = len(frames)
+        self.start_frame = min(max(start_frame, 0), self.total)
+        self.frames = frames[self.start_frame:]
+        self.video_path = video_path
+        self.options = dict(DEFAULT_EXPORT_OPTIONS)
+        if options is not None:
+            self.options.update(options)
+        self.rows, self.cols = get_grid(len(img_path_list), self.options['layout'])
+        self.labels = labels
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.progress = progress
+        self.num_skipped = 0
+        self.num_written = 0
+        self.fps = 0.
+        self.error = None
+        self.cancelled = False
+        self._stop = threading.Event()
+
+    def cancel(self):
+        """Stop the export. The frames written so far are kept in the video."""
+        self.cancelled = True
+        self._stop.set()
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self._stop.set()
+
+    def _put(self, q, item):
+        # do not block forever if another stage failed
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _compose(self, decode_queue, write_queue, free_canvases):
+        try:
+            while True:
+                futures = self._get(decode_queue)
+                if futures is None:  # end of frames or failure
+                    break
+                imgs = [future.result() for future in futures]
+                self.num_skipped += sum(img is None for img in imgs)
+                canvas = self._get(free_canvases)
+                if canvas is None:
+                    break
+                self._put(write_queue, compose(canvas, imgs, self.rows, self.cols))
+        except Exception as error:
+            self._fail(error)
+        finally:
+            self._put(write_queue, None)
+
+    def _write(self, write_queue, free_canvases, slots):
+        writer = None
+        done = 0
+        start_time = time.time()
+        try:
+            while True:
+                frame = self._get(write_queue)
+                if frame is None:
+                    break
+                if writer is None:
+                    height, width = frame.shape[:2]
+                    fourcc = cv2.VideoWriter_fourcc(*self.options['codec'])
+                    writer = cv2.VideoWriter(self.video_path, fourcc, float(self.options['fps']), (width, height))
+                    if not writer.isOpened():
+                        raise IOError(f'Cannot open the video writer for {self.video_path} '
+                                      f'with codec {self.options["codec"]}.')
+                    if self.options['quality']:
+                        writer.set(cv2.VIDEOWRITER_PROP_QUALITY, float(self.options['quality']))
+                writer.write(frame)
+                free_canvases.put(frame)  # recycle the canvas
+                slots.release()
+                done += 1
+                if self.progress is not None:
+                    self.progress(self.start_frame + done, self.total, done / max(time.time() - start_time, 1e-6))
+        except Exception as error:
+            self._fail(error)
+        finally:
+            if writer is not None:
+                writer.release()
+        self.num_written = done
+        self.fps = done / max(time.time() - start_time, 1e-6)
+
+    def run(self):
+        """Run the pipeline and block until all the frames are written.
+
+        Returns:
+            int: Number of written frames. Frames from start_frame +
+                num_written are not exported if it is cancelled.
+        """
+        if not self.frames:
+            return 0
+        # the first frame of the first view decides the size of all the views
+        first = load_view(self.frames[0][0], self.options['scale'], alpha_policy=self.options['alpha_policy'])
+        if first is None:
+            raise IOError(f'Cannot read the first frame {self.frames[0][0]}')
+        cell_size = first.shape[:2]
+        # preallocated output canvases, recycled after being written
+        free_canvases = queue.Queue()
+        for _ in range(QUEUE_SIZE + 2):
+            free_canvases.put(np.zeros((cell_size[0] * self.rows, cell_size[1] * self.cols, 3), dtype=np.uint8))
+
+        decode_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        write_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        # frames in flight (decoding, composing or waiting to be written)
+        slots = threading.BoundedSemaphore(2 * QUEUE_SIZE + self.num_workers)
+        composer = threading.Thread(
+            target=self._compose, args=(decode_queue, write_queue, free_canvases), daemon=True)
+        writer = threading.Thread(target=self._write, args=(write_queue, free_canvases, slots), daemon=True)
+        composer.start()
+        writer.start()
+        with ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='hv_export') as executor:
+            for paths in self.frames:
+                while not slots.acquire(timeout=0.1):
+                    if self._stop.is_set():
+                        break
+                if self._stop.is_set():
+                    break
+                futures = [
+                    executor.submit(load_view, path, self.options['scale'], label, cell_size,
+                                    self.options['size_policy'], self.options['alpha_policy'])
+                    for path, label in zip(paths, self.labels or [None] * len(paths))
+                ]
+                if not self._put(decode_queue, futures):
+                    break
+            self._put(decode_queue, None)
+            composer.join()
+            writer.join()
+        if self.error is not None:
+            raise self.error
+        return self.num_written
+
+
+class ExportJob():
+    """An export of the compare views, which can be queued and resumed.
+
+    Args:
+        img_path_list (list[list[str]]): Image paths of each view.
+        video_path (str): Output video path of the whole export.
+        options (dict): Export options, see DEFAULT_EXPORT_OPTIONS. Default: None.
+        folders (list[str]): Folder of each view, for the default labels. Default: None.
+        start_frame (int): Index of the first frame to export. Default: 0.
+    """
+
+    def __init__(self, img_path_list, video_path, options=None, folders=None, start_frame=0):
+        self.img_path_list = img_path_list
+        self.video_path = video_path
+        self.options = options
+        self.folders = folders
+        self.start_frame = start_frame
+        self.next_frame = start_frame  # the first frame not exported yet
+        self.num_frames = min((len(paths) for paths in img_path_list), default=0)
+        self.pipeline = None
+        self.cancelled = False
+
+    @property
+    def name(self):
+        return os.path.basename(self.output_path)
+
+    @property
+    def output_path(self):
+        return get_segment_path(self.video_path, self.start_frame)
+
+    @property
+    def is_complete(self):
+        return self.next_frame >= self.num_frames
+
+    def run(self, num_workers=None, progress=None):
+        """Run the export and block until it is done or cancelled.
+
+        Returns:
+            int: Number of written frames.
+        """
+        labels = get_labels(self.folders or [''] * len(self.img_path_list), (self.options or {}).get('labels', False))
+        self.pipeline = ExportPipeline(
+            self.img_path_list,
+            self.output_path,
+            options=self.options,
+            labels=labels,
+            num_workers=num_workers,
+            progress=progress,
+            start_frame=self.start_frame)
+        if self.cancelled:  # cancelled before the pipeline was created
+            self.pipeline.cancel()
+        try:
+            num = self.pipeline.run()
+        finally:
+            self.next_frame = self.pipeline.start_frame + self.pipeline.num_written
+        return num
+
+    def cancel(self):
+        self.cancelled = True
+        if self.pipeline is not None:
+            self.pipeline.cancel()
+
+
+def export_video(img_path_list, video_path, options=None, folders=None, num_workers=None, progress=None):
+    """Export the views to a video.
+
+    Args:
+        img_path_list (list[list[str]]): Image paths of each view.
+        video_path (str): Output video path.
+        options (dict): Export options, see DEFAULT_EXPORT_OPTIONS. Default: None.
+        folders (list[str]): Folder of each view, for the default labels. Default: None.
+
+    Returns:
+        float: Throughput in frames/s.
+    """
+    print("the frames number in each folder is:", [len(x) for x in img_path_list])
+    labels = get_labels(folders or [''] * len(img_path_list), (options or {}).get('labels', False))
+    if progress is None:
+
+        def progress(done, total, fps):
+            if done % 100 == 0 or done == total:
+                print(f'{done} / {total} frames, {fps:.1f} frames/s')
+
+    pipeline = ExportPipeline(
+        img_path_list, video_path, options=options, labels=labels, num_workers=num_workers, progress=progress)
+    num = pipeline.run()
+    if pipeline.num_skipped > 0:
+        print(f'{pipeline.num_skipped} views cannot be read and are black in the video.')
+    print(f'The output video is {video_path}, {num} frames, {pipeline.fps:.1f} frames/s')
+    return pipeline.fps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the compare folders to a video.')
+    parser.add_argument(
+        '--config', type=str, default=os.path.join(ROOT_DIR, 'history.json'), help='Compare config (history.json).')
+    parser.add_argument('--output', type=str, default=None, help='Output video. Default: video_path in the config.')
+    parser.add_argument('--layout', type=str, default=DEFAULT_EXPORT_OPTIONS['layout'], choices=LAYOUTS)
+    parser.add_argument('--fps', type=float, default=DEFAULT_EXPORT_OPTIONS['fps'])
+    parser.add_argument('--codec', type=str, default=DEFAULT_EXPORT_OPTIONS['codec'], help='FourCC, e.g., mp4v, avc1.')
+    parser.add_argument('--quality', type=int, default=DEFAULT_EXPORT_OPTIONS['quality'], help='0 - 100, 0: default.')
+    parser.add_argument('--scale', type=float, default=DEFAULT_EXPORT_OPTIONS['scale'], help='Downscale factor.')
+    parser.add_argument('--labels', nargs='*', default=None, help='Draw labels: folder names, or the given ones.')
+    parser.add_argument('--size_policy', type=str, default=DEFAULT_EXPORT_OPTIONS['size_policy'], choices=SIZE_POLICIES)
+    parser.add_argument(
+        '--alpha_policy', type=str, default=DEFAULT_EXPORT_OPTIONS['alpha_policy'], choices=ALPHA_POLICIES)
+    parser.add_argument('--workers', type=int, default=None, help='Number of decoding threads.')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as jf:
+        config = json.load(jf)
+    folders = get_compare_folders(config)
+    output = args.output or config.get('video_path', None)
+    if not folders or output is None:
+        parser.error('No view*_folder in the config, or no output path.')
+    options = {
+        'layout': args.layout,
+        'fps': args.fps,
+        'codec': args.codec,
+        'quality': args.quality,
+        'scale': args.scale,
+        'size_policy': args.size_policy,
+        'alpha_policy': args.alpha_policy,
+        # --labels: folder names; --labels a b: the given labels
+        'labels': False if args.labels is None else (args.labels or True)
+    }
+    export_video([get_img_list(folder) for folder in folders], output, options, folders, num_workers=args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,10 +2,14 @@
 We use the Graphics View Framework (https://doc.qt.io/qt-5/graphicsview.html)
 for our HandyView.
 """
-from PyQt5 import QtCore
+from PyQt5 import QtCore, sip
 from PyQt5.QtCore import QPoint, QRect, QSize, Qt
-from PyQt5.QtGui import QColor, QFont, QFontMetrics, QTransform
-from PyQt5.QtWidgets import QApplication, QGraphicsScene, QGraphicsView, QRubberBand
+from PyQt5.QtGui import QColor, QFont, QFontMetrics, QPen, QTransform
+from PyQt5.QtWidgets import QApplication, QGraphicsRectItem, QGraphicsScene, QGraphicsView, QRubberBand
+
+from handyview.prefetch import get_pixmap
+from handyview.pyramid import HVPixmapItem
+from handyview.tiles import HVTiledItem, TiledImage
 
 
 class HVView(QGraphicsView):
@@ -224,6 +228,10 @@ class HVView(QGraphicsView):
 
 class HVScene(QGraphicsScene):
     """A customized QGraphicsScene for HandyView.
+
+    The image items are persistent and updated in place by set_image, so
+    browsing does not rebuild the scene. The border of the compare main
+    image is an overlay item, instead of being drawn into the pixels.
     """
 
     def __init__(self, parent=None, show_info=True):
@@ -232,11 +240,63 @@ class HVScene(QGraphicsScene):
         self.show_info = show_info
         self.width = None
         self.height = None
+        # created on the first set_image
+        self.pixmap_item = None
+        self.tiled_item = None
+        self.border_item = None
 
     def set_width_height(self, width, height):
         self.width = width
         self.height = height
 
+    def _valid(self, item):
+        # items are deleted by clear() (e.g., in the video canvas)
+        return item is not None and not sip.isdeleted(item)
+
+    def set_image(self, qimg, key, border=False):
+        """Show an image, updating the persistent items in place.
+
+        Args:
+            qimg (QImage | TiledImage): Decoded image, or the tile source of a giant image.
+            key (tuple): Cache key of the image, i.e., (path, mtime).
+            border (bool): Show the red border of the compare main image. Default: False.
+        """
+        width, height = qimg.width(), qimg.height()
+        if isinstance(qimg, TiledImage):
+            if self._valid(self.tiled_item):
+                self.tiled_item.set_image(qimg)
+            else:
+                self.tiled_item = HVTiledItem(qimg)
+                self.addItem(self.tiled_item)
+            self.tiled_item.setVisible(True)
+            if self._valid(self.pixmap_item):
+                self.pixmap_item.setVisible(False)
+        else:
+            qpixmap = get_pixmap(qimg, key)
+            if self._valid(self.pixmap_item):
+                self.pixmap_item.set_image(qpixmap, key)
+            else:
+                self.pixmap_item = HVPixmapItem(qpixmap, key)
+                self.addItem(self.pixmap_item)
+            self.pixmap_item.setVisible(True)
+            if self._valid(self.tiled_item):
+                self.tiled_item.setVisible(False)
+
+        if border:
+            if not self._valid(self.border_item):
+                self.border_item = QGraphicsRectItem()
+                self.border_item.setPen(QPen(QColor(220, 0, 0), 5, QtCore.Qt.SolidLine))
+                self.border_item.setZValue(1)  # above the image
+                self.addItem(self.border_item)
+            self.border_item.setRect(0, 0, width, height)
+            self.border_item.setVisible(True)
+        elif self._valid(self.border_item):
+            self.border_item.setVisible(False)
+
+        self.set_width_height(width, height)
+        # put image always in the center of a QGraphicsView
+        self.setSceneRect(0, 0, width, height)
+
     def keyPressEvent(self, event):
         modifiers = QApplication.keyboardModifiers()
         if modifiers == QtCore.Qt.ControlModifier:
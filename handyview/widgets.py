@@ -6,7 +6,7 @@ import os
 from PyQt5 import QtCore
 from PyQt5.QtGui import QColor, QFont, QIcon, QPixmap, QIntValidator, QDoubleValidator
 from PyQt5.QtWidgets import QDialog, QFrame, QHBoxLayout, QLabel, QMessageBox, QPushButton, QVBoxLayout, \
-    QFormLayout, QLineEdit, QSpinBox, QWidget, QGridLayout
+    QFormLayout, QLineEdit, QSpinBox, QWidget, QGridLayout, QCheckBox, QComboBox, QDoubleSpinBox
 
 from handyview.utils import ROOT_DIR
 
@@ -218,3 +218,87 @@ class CompareSettingEdit(QDialog):
             config["view%d_folder" % idx] = getattr(self, "view%d_folder_line"%idx).text()
         config["zoom_factor"] = float(self.zoom_factor_line.text())
         return config
+
+
+class ExportVideoSetting(QDialog):
+    """Dialog for the video path and the export options (see video_export.DEFAULT_EXPORT_OPTIONS)."""
+
+    def __init__(self, video_path, options, layouts, codecs, size_policies, alpha_policies, start_frame=0,
+                 num_frames=0) -> None:
+        super(ExportVideoSetting, self).__init__()
+        self.setWindowTitle("Export Video")
+        self.setMinimumWidth(600)
+
+        self.path_line = QLineEdit(str(video_path))
+        self.layout_combo = QComboBox()
+        self.layout_combo.addItems(layouts)
+        self.layout_combo.setCurrentText(options["layout"])
+        self.fps_spin = QDoubleSpinBox()
+        self.fps_spin.setRange(1, 120)
+        self.fps_spin.setValue(float(options["fps"]))
+        self.codec_combo = QComboBox()
+        self.codec_combo.setEditable(True)  # any FourCC supported by OpenCV
+        self.codec_combo.addItems(codecs)
+        self.codec_combo.setCurrentText(options["codec"])
+        self.quality_spin = QSpinBox()
+        self.quality_spin.setRange(0, 100)
+        self.quality_spin.setValue(int(options["quality"]))
+        self.scale_spin = QDoubleSpinBox()
+        self.scale_spin.setRange(0.05, 1.0)
+        self.scale_spin.setSingleStep(0.25)
+        self.scale_spin.setValue(float(options["scale"]))
+        self.labels_check = QCheckBox("folder names")
+        self.labels_check.setChecked(bool(options["labels"]))
+        self.size_combo = QComboBox()
+        self.size_combo.addItems(size_policies)
+        self.size_combo.setCurrentText(options["size_policy"])
+        self.alpha_combo = QComboBox()
+        self.alpha_combo.addItems(alpha_policies)
+        self.alpha_combo.setCurrentText(options["alpha_policy"])
+        # resume a cancelled export; the remaining frames go to a new segment file
+        self.start_spin = QSpinBox()
+        self.start_spin.setRange(0, max(num_frames - 1, 0))
+        self.start_spin.setValue(start_frame)
+
+        self.flo = QFormLayout()
+        self.flo.addRow("Video path", self.path_line)
+        self.flo.addRow("Layout", self.layout_combo)
+        self.flo.addRow("FPS", self.fps_spin)
+        self.flo.addRow("Codec", self.codec_combo)
+        self.flo.addRow("Quality (0: default)", self.quality_spin)
+        self.flo.addRow("Scale", self.scale_spin)
+        self.flo.addRow("Labels", self.labels_check)
+        self.flo.addRow("Different sizes", self.size_combo)
+        self.flo.addRow("Alpha", self.alpha_combo)
+        self.flo.addRow("Start frame", self.start_spin)
+
+        ### add save/cancel button
+        self.save_button = QPushButton("Export")
+        self.cancel_button = QPushButton("Cancel")
+        bt_layout = QHBoxLayout()
+        bt_layout.addWidget(self.save_button)
+        bt_layout.addWidget(self.cancel_button)
+
+        box_layout = QVBoxLayout()
+        box_layout.addLayout(self.flo)
+        box_layout.addLayout(bt_layout)
+        self.setLayout(box_layout)
+
+        self.save_button.clicked.connect(self.accept)
+        self.cancel_button.clicked.connect(self.reject)
+
+    def exportConfig(self):
+        options = {
+            "layout": self.layout_combo.currentText(),
+            "fps": self.fps_spin.value(),
+            "codec": self.codec_combo.currentText(),
+            "quality": self.quality_spin.value(),
+            "scale": self.scale_spin.value(),
+            "labels": self.labels_check.isChecked(),
+            "size_policy": self.size_combo.currentText(),
+            "alpha_policy": self.alpha_combo.currentText(),
+        }
+        return self.path_line.text(), options
+
+    def startFrame(self):
+        return self.start_spin.value()
@@ -0,0 +1,267 @@
+"""
+Background workers (QThread), which keep long computations off the GUI thread.
+"""
+import os
+import threading
+import time
+from functools import lru_cache
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from handyview.utils import compute_fingerprint, crop_images
+
+# the images found by ScanWorker are emitted at most once per interval (seconds)
+SCAN_EMIT_INTERVAL = 0.2
+
+
+class FingerprintWorker(QThread):
+    """Compute fingerprints (md5 and phash) in the background.
+
+    Jobs are (db, fidx, pidx, path) tuples. set_jobs replaces the pending jobs,
+    so only the images that are still shown get computed. A job for the image
+    being computed is skipped, and a fingerprint already in the persistent
+    cache (e.g., computed just before the job was queued again) is not
+    computed again. The worker only
+    reads the files (and writes the persistent cache): the results are
+    applied to the db on the GUI thread (HVDB.set_fingerprint), as the path
+    lists may have changed meanwhile.
+    """
+    progress = pyqtSignal(str, int, int)  # path, done bytes, total bytes
+    computed = pyqtSignal(object, int, int, str, str, str)  # db, fidx, pidx, path, md5, phash hex string
+
+    def __init__(self):
+        super(FingerprintWorker, self).__init__()
+        self._jobs = []
+        self._current = None  # the path being computed
+        self._lock = threading.Lock()
+        # restart if jobs are added when the run loop is exiting
+        self.finished.connect(self._restart)
+
+    def set_jobs(self, jobs):
+        with self._lock:
+            self._jobs = [job for job in jobs if job[3] != self._current]
+        if not self.isRunning():
+            self.start()
+
+    def _restart(self):
+        with self._lock:
+            has_jobs = len(self._jobs) > 0
+        if has_jobs:
+            self.start()
+
+    def run(self):
+        while True:
+            with self._lock:
+                self._current = None
+                if not self._jobs:
+                    break
+                db, fidx, pidx, path = self._jobs.pop(0)
+                self._current = path
+            name = os.path.basename(path)
+            try:
+                stat = os.stat(path)
+                md5, phash = db.cache.get_fingerprint(path, stat.st_size, stat.st_mtime)
+                if md5 is None or phash is None:
+                    md5, phash = compute_fingerprint(
+                        path, progress=lambda done, total: self.progress.emit(name, done, total))
+                    db.cache.set_fingerprint(path, stat.st_size, stat.st_mtime, md5, phash)
+            except Exception as error:
+                print(f'Fingerprint error for {path}: {error}')
+                continue
+            self.computed.emit(db, fidx, pidx, path, md5, phash)
+
+
+class IndexWorker(QThread):
+    """Get the fingerprints for the index of all the folders, from the cache or computed (HVDB.compute_fingerprints).
+
+    The results are emitted, and merged into the db on the GUI thread (HVDB.merge_fingerprints).
+    """
+    progress = pyqtSignal(int, int)  # done, total
+    indexed = pyqtSignal(list)  # (fidx, pidx, path, md5, phash hex string) of the computed images
+
+    def __init__(self, db, jobs, done=0, total=None, parent=None):
+        super(IndexWorker, self).__init__(parent)
+        self.db = db
+        self.jobs = jobs
+        self.done = done
+        self.total = total
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        results = []
+        try:
+            results = self.db.compute_fingerprints(
+                self.jobs,
+                self.done,
+                self.total,
+                progress=lambda done, total: self.progress.emit(done, total),
+                is_cancelled=lambda: self._cancelled)
+        except Exception as error:
+            print(f'Index error: {error}')
+        self.indexed.emit(results)
+
+
+class ScanWorker(QThread):
+    """Consume the rest of a recursive scan (utils.scan_tree) in the background, emitting the found images."""
+    found = pyqtSignal(list)  # image paths
+    scanned = pyqtSignal()  # the scan is complete
+
+    def __init__(self, scan, parent=None):
+        super(ScanWorker, self).__init__(parent)
+        self.scan = scan
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        paths = []
+        last_emit = time.time()
+        for files in self.scan:
+            if self._cancelled:
+                break
+            paths.extend(files)
+            # batch the small directories, so the GUI thread is not flooded
+            if time.time() - last_emit >= SCAN_EMIT_INTERVAL:
+                self.found.emit(paths)
+                paths = []
+                last_emit = time.time()
+        self.scan.close()
+        if not self._cancelled:
+            if paths:
+                self.found.emit(paths)
+            self.scanned.emit()
+
+
+class ListingWorker(QThread):
+    """Rescan folders (HVDB.scan_folder), e.g., the ones changed on disk or loaded from the persistent listing cache.
+
+    The new scans are compared with the scans at creation time, and only the
+    added and removed images are applied on the GUI thread (HVDB.apply_folder_scan).
+    """
+    scanned = pyqtSignal(str, object, list, list, list)  # folder, old scan, image list, added, removed
+
+    def __init__(self, db, folders, parent=None):
+        super(ListingWorker, self).__init__(parent)
+        self.db = db
+        self.folders = folders
+        self.scans = {folder: db.folder_scans.get(folder) for folder in folders}
+
+    def run(self):
+        for folder in self.folders:
+            img_list = self.db.scan_folder(folder, use_cache=False)
+            old_scan = self.scans[folder]
+            if old_scan is None:
+                added, removed = img_list, []
+            else:
+                old_paths, new_paths = set(old_scan), set(img_list)
+                added = [path for path in img_list if path not in old_paths]
+                removed = [path for path in old_scan if path not in new_paths]
+            self.scanned.emit(folder, old_scan, img_list, added, removed)
+
+
+class CropWorker(QThread):
+    """Crop rects from the images of several folders in a process pool (utils.crop_images)."""
+    progress = pyqtSignal(int, int)  # done, total
+    cropped = pyqtSignal(int, str)  # number of cropped images, error message ('' for success)
+
+    def __init__(self, path_lists, rects, patch_folder, parent=None, **kwargs):
+        super(CropWorker, self).__init__(parent)
+        self.path_lists = path_lists
+        self.rects = rects
+        self.patch_folder = patch_folder
+        self.kwargs = kwargs
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        try:
+            num = crop_images(
+                self.path_lists,
+                self.rects,
+                self.patch_folder,
+                progress=lambda done, total: self.progress.emit(done, total),
+                is_cancelled=lambda: self._cancelled,
+                **self.kwargs)
+        except Exception as error:
+            self.cropped.emit(0, str(error))
+        else:
+            self.cropped.emit(num, '')
+
+
+class ExportWorker(QThread):
+    """Run the queued video exports (video_export.ExportJob) back to back."""
+    progress = pyqtSignal(object, int, int, float, float)  # job, done, total, frames/s, ETA in seconds
+    job_done = pyqtSignal(object, str)  # job, error message ('' for success or cancellation)
+
+    def __init__(self):
+        super(ExportWorker, self).__init__()
+        self._jobs = []
+        self._current = None
+        self._lock = threading.Lock()
+        self.finished.connect(self._restart)
+
+    def add_job(self, job):
+        with self._lock:
+            self._jobs.append(job)
+        if not self.isRunning():
+            self.start()
+
+    def pending_jobs(self):
+        """The jobs waiting to run, excluding the running one."""
+        with self._lock:
+            return list(self._jobs)
+
+    def cancel(self, job=None):
+        """Cancel a job (default: the running one). A pending job is removed from the queue."""
+        with self._lock:
+            if job is None or job is self._current:
+                if self._current is not None:
+                    self._current.cancel()
+            elif job in self._jobs:
+                self._jobs.remove(job)
+
+    def _restart(self):
+        with self._lock:
+            has_jobs = len(self._jobs) > 0
+        if has_jobs:
+            self.start()
+
+    def run(self):
+        while True:
+            with self._lock:
+                if not self._jobs:
+                    self._current = None
+                    break
+                job = self._current = self._jobs.pop(0)
+            start_time = time.time()
+
+            def progress(done, total, fps, job=job):
+                elapsed = time.time() - start_time
+                exported = done - job.start_frame
+                eta = (total - done) * elapsed / exported if exported > 0 else -1.
+                self.progress.emit(job, done, total, fps, eta)
+
+            message = ''
+            try:
+                job.run(progress=progress)
+            except Exception as error:
+                print(f'Export error for {job.output_path}: {error}')
+                message = str(error)
+            self.job_done.emit(job, message)
+
+
+@lru_cache(maxsize=None)
+def get_fingerprint_worker():
+    """Get the fingerprint worker shared by all canvases."""
+    return FingerprintWorker()
+
+
+@lru_cache(maxsize=None)
+def get_export_worker():
+    """Get the export worker shared by all windows, so that exports run one by one."""
+    return ExportWorker()